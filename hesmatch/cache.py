@@ -0,0 +1,125 @@
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class DiskCache:
+    """
+    Directory of analysis and matching results stored as .npz files named by their key,
+    which can be shared by concurrent jobs, also on a shared file system.
+
+    Entries are written to a temporary file and renamed into place, so readers never see
+    partial entries. Reading an entry marks it as recently used. If max_size is given,
+    the least recently used entries are removed after every write until the cache is
+    smaller than max_size. Writes and evictions hold an exclusive lock (fcntl.flock) on
+    the lock file of the directory, which is skipped on platforms without fcntl.
+
+    Parameters
+    ----------
+    directory : str
+        Created if it does not exist.
+    max_size : int, optional
+        Size in bytes. The default is None, no eviction.
+
+    """
+
+    LOCK_FILE = 'cache.lock'
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Key of an entry from its parts, e.g. the hash of a Hessian and the parameters of
+        the analysis. Numpy arrays are keyed by their values.
+        """
+        parts = [np.asarray(part).tolist() if isinstance(part, np.ndarray) else part
+                 for part in parts]
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Dictionary of the arrays stored under key, or None if there is no such entry.
+        """
+        path = self._get_path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return arrays
+
+    def put(self, key, **arrays):
+        """
+        Store the arrays under key, replacing an existing entry.
+        """
+        file, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(file, 'wb') as f:
+            np.savez(f, **arrays)
+
+        with self._lock():
+            os.replace(temp_path, self._get_path(key))
+            if self.max_size is not None:
+                self._evict()
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock():
+            for path in self._get_entries():
+                _remove(path)
+
+    def _evict(self):
+        entries = []
+        for path in self._get_entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            _remove(path)
+            size -= entry_size
+
+    def _get_entries(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith('.npz')]
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    @contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+
+        with open(os.path.join(self.directory, self.LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
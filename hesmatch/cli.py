@@ -1,23 +1,78 @@
+import glob
+import os
+from contextlib import closing
+import sys
+import tarfile
 from colt import from_commandline
 import numpy as np
-from .hesmatch import hesmatch
+from scipy.sparse import coo_matrix
+from .hesmatch import hesmatch, hesmatch_isotopologues
+from .cache import DiskCache
+from .journal import consolidate_journals
+from .pipeline import prefetch
+from .protocol import MAGIC, iter_arrays
+from .readers import (detect_format, get_reader, open_hessian_file, read_1d_file, read_2d_file,
+                      read_hessian_file, read_qm_file, strip_compression)
+from .server import MatchServer, serve_socket, serve_stdio
 
 
 @from_commandline("""
-    # Path of the reference Hessian file
-    ref_file = :: existing_file
+    # Path of the reference Hessian file, - for stdin (the first frame of a framed stdin,
+    # whose remaining frames are then read by match_file -)
+    ref_file = :: str
 
-    # Path of the matched Hessian file(s)
-    match_file = :: list(existing_file)
+    # Path of the matched Hessian file(s). Directories, glob patterns, tar archives,
+    # .npz/HDF5 containers and framed streams (.hesm files or - for stdin, see
+    # hesmatch.protocol) of several Hessians are read one Hessian at a time
+    match_file = :: list(str)
 
-    # File containing the mass of the atoms for mass-weighed analysis
+    # File containing the mass of the atoms for mass-weighed analysis. The default for QM
+    # program files (ref_format fchk, orca or qchem) are the masses in the file
     mass_file = :: existing_file, optional
 
+    # Read one set of masses per line of mass_file and match each isotopologue (only with
+    # the geometry, format, unit, precision and degenerate_tol options)
+    isotopologues = False :: bool
+
+    # Number of isotopologues diagonalized together (default: all)
+    batch_size = :: int, optional
+
+    # File containing the Cartesian coordinates (A) of the reference geometry, one atom per line,
+    # for an exact projection of the rigid-body modes
+    geometry_file = :: existing_file, optional
+
+    # Indices (starting from 0) of the atoms to restrict the analysis and matching to
+    atom_indices = :: list(int), optional
+
+    # Treatment of the other atoms for atom_indices (extract: frozen, schur: relaxed)
+    subset_method = extract :: str :: [extract, schur]
+
+    # Diagonalize the Hessians of non-interacting fragments separately
+    fragments = False :: bool
+
+    # Only compute and match this many modes, the ones closest to target_freq
+    n_modes = :: int, optional
+
+    # Frequency (cm-1) around which the n_modes modes are computed
+    target_freq = :: float, optional
+
+    # Precision of reading and analysing the Hessians (single: float32, double: float64),
+    # with refine the Hessians are read in double precision
+    precision = double :: str :: [single, double]
+
+    # Refine the frequencies of single precision analyses in double precision
+    refine = False :: bool
+
     # Format of the provided Hessian matrix for the reference
-    ref_format = 2d :: str :: [2d, upper, lower]
+    # (sparse: .npz from scipy.sparse, binary .coo or text "row column value" triplets;
+    # fchk: Gaussian, orca: ORCA .hess, fcm: CFOUR/Psi4 force constants, qchem: Q-Chem output,
+    # always in Hartree Bohr-2 regardless of ref_unit; mtx: GROMACS binary full or sparse
+    # matrix, always in kJ mol-1 nm-2; auto: detected from the file name or content;
+    # further formats of the hesmatch.readers entry points of installed packages)
+    ref_format = 2d :: str
 
-    # Format of the matched Hessian matrices
-    match_format = 2d :: str :: [2d, upper, lower]
+    # Format of the matched Hessian matrices (auto: detected from the first file)
+    match_format = 2d :: str
 
     # Units of the reference Hessian matrix (1: kJ mol-1 A-2, 2: kJ mol-1 nm-2, 3: Hartree Bohr-2)
     ref_unit = 1 :: int :: [1, 2, 3]
@@ -25,42 +80,319 @@ from .hesmatch import hesmatch
     # Units of the matched Hessian matrices (1: kJ mol-1 A-2, 2: kJ mol-1 nm-2, 3: Hartree Bohr-2)
     match_unit = 1 :: int :: [1, 2, 3]
 
+    # Frequency gap (cm-1) below which modes are matched as degenerate subspaces
+    degenerate_tol = :: float, optional
+
+    # Number of match Hessians read ahead in a background thread (0: no read-ahead)
+    prefetch_size = 2 :: int
+
+    # Number of threads analysing match Hessians (0: all CPUs)
+    n_jobs = 1 :: int
+
+    # Number of worker processes analysing and matching the match Hessians through shared
+    # memory (0: analyse and match in this process, -1: planned from the Hessian size
+    # and the number of CPUs)
+    n_procs = 0 :: int
+
+    # Journal recording the result of every match, from which an interrupted run resumes
+    journal_file = :: str, optional
+
+    # .npz file to save the consolidated results of journal_file to after the run
+    results_file = :: str, optional
+
+    # Directory of a persistent cache of analyses and matching results, may be shared by
+    # concurrent runs
+    cache_dir = :: str, optional
+
+    # Size (MB) above which the least recently used cache entries are removed
+    cache_size = :: float, optional
+
+    # Number of BLAS threads per process, requires threadpoolctl (default: planned for
+    # n_procs = -1, otherwise left to the BLAS library)
+    blas_threads = :: int, optional
+
     """, description={'alias': 'hesmatch'})
-def cli(ref_file, match_file, mass_file, ref_format, match_format, ref_unit, match_unit):
+def cli(ref_file, match_file, mass_file, isotopologues, batch_size, geometry_file,
+        atom_indices, subset_method, fragments, n_modes, target_freq, precision, refine,
+        ref_format, match_format, ref_unit, match_unit, degenerate_tol, prefetch_size, n_jobs,
+        n_procs, blas_threads, journal_file, results_file, cache_dir, cache_size):
+
+    if isotopologues:
+        check_isotopologue_options(mass_file, atom_indices=atom_indices,
+                                   subset_method=subset_method != 'extract',
+                                   fragments=fragments, n_modes=n_modes,
+                                   target_freq=target_freq, refine=refine,
+                                   n_jobs=n_jobs != 1, n_procs=n_procs,
+                                   blas_threads=blas_threads, journal_file=journal_file,
+                                   results_file=results_file, cache_dir=cache_dir)
+
+    check_sources(match_file)
+
+    # Refining needs the Hessians as given, only the analyses are rounded
+    dtype = np.float32 if precision == 'single' and not refine else np.float64
+    ref, ref_format, ref_unit, ref_masses = read_reference(ref_file, ref_format, ref_unit,
+                                                           dtype)
+    if match_format == 'auto':
+        match_format = resolve_format(match_file[0])
+    match_reader = get_reader(match_format)
+    match_unit = match_reader.unit or match_unit
 
-    ref = read_hessian([ref_file], ref_format)[0]
-    match = read_hessian(match_file, match_format)
+    match = iter_hessians(match_file, match_format, dtype, match_unit)
+    match_format = match_reader.layout
+    if prefetch_size > 0:
+        match = prefetch(match, prefetch_size)
 
-    if mass_file:
-        masses = read_1d_file(mass_file)
+    if geometry_file:
+        positions = read_2d_file(geometry_file)
     else:
-        masses = None
+        positions = None
+
+    if isotopologues:
+        mass_sets = np.loadtxt(mass_file, ndmin=2)
+        hesmatch_isotopologues(ref, list(match), mass_sets, ref_format, match_format, ref_unit,
+                               match_unit, degenerate_tol, positions, precision, batch_size)
+        return
+
+    masses = read_1d_file(mass_file) if mass_file else ref_masses
+
+    if n_procs == -1:
+        n_procs = 'auto'
+
+    cache = None
+    if cache_dir:
+        cache = DiskCache(cache_dir, None if cache_size is None else int(cache_size * 1e6))
+
+    hesmatch(ref, match, masses, ref_format, match_format, ref_unit, match_unit, degenerate_tol,
+             positions, atom_indices, subset_method, fragments, n_modes, target_freq, precision,
+             refine, n_jobs or None, n_procs or None, blas_threads, journal_file,
+             cache)
+
+    if journal_file and results_file:
+        consolidate_journals([journal_file], results_file)
+
+
+def check_isotopologue_options(mass_file, **options):
+    """
+    Raise a ValueError if there is no mass_file of the isotopologues or if one of the
+    options, given as whether they are set, is not supported with isotopologues.
+    """
+    if not mass_file:
+        raise ValueError("isotopologues requires a mass_file with one set of masses per line.")
+    unsupported = [name for name, value in options.items() if value]
+    if unsupported:
+        raise ValueError(f"isotopologues cannot be combined with {', '.join(unsupported)}.")
+
+
+STDIN = '-'
+# colt parses a lone - as an option, main passes it on as STDIN_PATH
+STDIN_PATH = '/dev/stdin'
+FRAMED_EXTENSIONS = ('.hesm',)
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+HDF5_EXTENSIONS = ('.h5', '.hdf5')
+
+
+def check_sources(sources):
+    """
+    Raise a FileNotFoundError for sources that are neither stdin nor an existing path nor
+    a glob pattern matching one, before they are read in the background.
+    """
+    for source in sources:
+        if source in (STDIN, STDIN_PATH) or os.path.exists(source):
+            continue
+        if not glob.has_magic(source):
+            raise FileNotFoundError(f"No such Hessian file or directory: '{source}'.")
+        if not glob.glob(source):
+            raise FileNotFoundError(f"No Hessian file matches '{source}'.")
+
 
-    hesmatch(ref, match, masses, ref_format, match_format, ref_unit, match_unit)
+def read_reference(ref_file, ref_format, ref_unit, dtype=float):
+    """
+    Reference Hessian of a file in a format of the reader registry ('auto': detected), with
+    the layout and unit (ref_unit unless fixed by the format) of the Hessian and the masses
+    of a QM program file (else None).
+    """
+    if ref_format == 'auto':
+        ref_format = resolve_format(ref_file)
+    reader = get_reader(ref_format)
+    if reader.text:
+        data = read_qm_file(ref_file, ref_format, dtype)
+        return data.hessian, data.hes_format, data.unit, data.masses
 
+    ref_unit = reader.unit or ref_unit
+    # Only the first Hessian is taken, so that a framed stdin can hold the reference
+    # followed by the matches
+    with closing(iter_hessians([ref_file], ref_format, dtype, ref_unit)) as hessians:
+        return next(hessians), reader.layout, ref_unit, None
 
-def read_hessian(hes_files, hes_format):
-    hessians = []
-    for hes_file in hes_files:
-        if hes_format == '2d':
-            hessians.append(read_2d_file(hes_file))
+
+def read_hessian(hes_files, hes_format, dtype=float):
+    return list(iter_hessians(hes_files, hes_format, dtype))
+
+
+def iter_hessians(sources, hes_format, dtype=float, unit=None):
+    """
+    Yield the Hessians of the sources one at a time, so that only the Hessian being
+    analysed is held in memory. A source is a Hessian file, a directory (its files in
+    sorted order), a glob pattern, a tar archive (its files in archive order), a .npz
+    archive of several arrays, an HDF5 file (all datasets, requires h5py), a .hesm file
+    of array frames (see protocol) or - for stdin, which holds either array frames or a
+    single Hessian. Array frames are converted to the layout of hes_format and to unit,
+    see protocol.iter_arrays.
+    """
+    for source in sources:
+        if source in (STDIN, STDIN_PATH):
+            yield from read_stream(sys.stdin.buffer, hes_format, dtype, unit)
+        elif os.path.isdir(source):
+            paths = [os.path.join(source, name) for name in sorted(os.listdir(source))]
+            yield from iter_hessians([path for path in paths if os.path.isfile(path)],
+                                     hes_format, dtype, unit)
+        elif not os.path.exists(source):
+            paths = sorted(glob.glob(source))
+            if not paths:
+                raise FileNotFoundError(f"No Hessian file matches '{source}'.")
+            yield from iter_hessians(paths, hes_format, dtype, unit)
+        elif strip_compression(source).endswith(FRAMED_EXTENSIONS):
+            with open_hessian_file(source) as f:
+                yield from iter_arrays(f, dtype, get_reader(hes_format).layout, unit)
+        elif source.endswith(TAR_EXTENSIONS):
+            yield from _iter_tar(source, hes_format, dtype)
+        elif source.endswith('.npz') and hes_format != 'sparse':
+            with np.load(source) as archive:
+                for name in archive.files:
+                    yield archive[name].astype(dtype, copy=False)
+        elif source.endswith(HDF5_EXTENSIONS):
+            yield from _iter_hdf5(source, hes_format, dtype)
         else:
-            hessians.append(read_1d_file(hes_file))
-    return hessians
+            yield read_hessian_file(source, hes_format, dtype)
+
+
+def resolve_format(source):
+    """
+    Format of a source detected by readers.detect_format, from its first file for
+    directories and glob patterns.
+    """
+    if source in (STDIN, STDIN_PATH):
+        raise ValueError("The format of stdin cannot be detected, give it explicitly.")
+
+    path = source
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in sorted(os.listdir(source))]
+        path = next((path for path in paths if os.path.isfile(path)), source)
+    elif not os.path.exists(source):
+        path = next(iter(sorted(glob.glob(source))), source)
+
+    hes_format = detect_format(path) if os.path.isfile(path) else None
+    if hes_format is None:
+        raise ValueError(f"Cannot detect the Hessian format of '{source}', give it explicitly.")
+    return hes_format
+
+
+def read_stream(stream, hes_format, dtype=float, unit=None):
+    """
+    Yield the Hessians of a buffered binary stream, which holds either array frames (see
+    protocol, converted to the layout of hes_format and to unit) or a single Hessian in
+    the text format of the files.
+    """
+    if stream.peek(len(MAGIC))[:len(MAGIC)] == MAGIC:
+        yield from iter_arrays(stream, dtype, get_reader(hes_format).layout, unit)
+    else:
+        yield read_hessian_file(stream, hes_format, dtype, name=STDIN)
 
 
-def read_2d_file(file):
-    return np.loadtxt(file)
+def _iter_tar(file, hes_format, dtype):
+    # Iterating over the archive reads the members as they are needed
+    with tarfile.open(file) as archive:
+        for member in archive:
+            if member.isfile():
+                with archive.extractfile(member) as member_file:
+                    yield read_hessian_file(member_file, hes_format, dtype, member.name)
 
 
-def read_1d_file(file):
-    data = []
-    with open(file, 'r') as f:
-        for line in f:
-            if line.strip != '':
-                data.extend(line.split())
-    return np.array(data, dtype=float)
+def _iter_hdf5(file, hes_format, dtype):
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("Reading HDF5 files requires h5py.") from None
+
+    with h5py.File(file, 'r') as archive:
+        names = []
+        archive.visititems(lambda name, item: names.append(name)
+                           if isinstance(item, h5py.Dataset) else None)
+        for name in names:
+            hessian = archive[name][()].astype(dtype, copy=False)
+            yield coo_matrix(hessian) if hes_format == 'sparse' else hessian
+
+
+@from_commandline("""
+    # Path of the reference Hessian file
+    ref_file = :: existing_file
+
+    # Unix socket to listen on. Without it, requests are read from stdin and answered on
+    # stdout in the binary framing of hesmatch.protocol
+    socket = :: str, optional
+
+    # File containing the mass of the atoms for mass-weighed analysis. The default for QM
+    # program files (ref_format fchk, orca or qchem) are the masses in the file
+    mass_file = :: existing_file, optional
+
+    # File containing the Cartesian coordinates (A) of the reference geometry, one atom per line,
+    # for an exact projection of the rigid-body modes
+    geometry_file = :: existing_file, optional
+
+    # Precision of reading and analysing the Hessians (single: float32, double: float64)
+    precision = double :: str :: [single, double]
+
+    # Format of the provided Hessian matrix for the reference, any format of hesmatch
+    # (fchk, orca, fcm and qchem always in Hartree Bohr-2, mtx always in kJ mol-1 nm-2,
+    # auto: detected from the file name or content)
+    ref_format = 2d :: str
+
+    # Default format of the matched Hessian matrices, whose layout and unit are taken
+    # for the arrays of the requests
+    match_format = 2d :: str
+
+    # Units of the reference Hessian matrix (1: kJ mol-1 A-2, 2: kJ mol-1 nm-2, 3: Hartree Bohr-2)
+    ref_unit = 1 :: int :: [1, 2, 3]
+
+    # Default units of the matched Hessian matrices
+    match_unit = 1 :: int :: [1, 2, 3]
+
+    # Frequency gap (cm-1) below which modes are matched as degenerate subspaces
+    degenerate_tol = :: float, optional
+
+    """, description={'alias': 'hesmatch serve'})
+def serve(ref_file, socket, mass_file, geometry_file, precision, ref_format, match_format,
+          ref_unit, match_unit, degenerate_tol):
+
+    dtype = np.float32 if precision == 'single' else np.float64
+    ref, ref_format, ref_unit, ref_masses = read_reference(ref_file, ref_format, ref_unit,
+                                                           dtype)
+    match_reader = get_reader(match_format)
+    match_format, match_unit = match_reader.layout, match_reader.unit or match_unit
+    masses = read_1d_file(mass_file) if mass_file else ref_masses
+    positions = read_2d_file(geometry_file) if geometry_file else None
+
+    def start_server():
+        return MatchServer(ref, masses, ref_format, match_format, ref_unit, match_unit,
+                           degenerate_tol, positions, precision)
+
+    if socket:
+        serve_socket(start_server(), socket)
+    else:
+        serve_stdio(start_server())
+
+
+def main():
+    """
+    Entry point of the hesmatch command, with the subcommand serve.
+    """
+    sys.argv = [STDIN_PATH if arg == STDIN else arg for arg in sys.argv]
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        del sys.argv[1]
+        serve()
+    else:
+        cli()
 
 
 if __name__ == '__main__':
-    cli()
+    main()
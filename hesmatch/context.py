@@ -0,0 +1,133 @@
+import threading
+from math import sqrt
+import numpy as np
+from ase import Atoms
+from .hessian import get_internal_basis
+
+
+class AnalysisContext:
+    """
+    Quantities shared by all vibrational analyses of one molecule.
+
+    Create it once per molecule and pass it to every reference and match analysis, which
+    then reuse the Atoms object, the inverse square root masses, the mass-weighting vectors
+    with the unit conversion folded in, the triangle index arrays of packed Hessians, the
+    internal basis and a workspace for the mass-weighted Hessian instead of rebuilding them.
+
+    Parameters
+    ----------
+    masses : (n_atom) Numpy array, optional
+        The default is None, which sets all masses to 1 (no mass-weighting) and then
+        requires n_atoms.
+    n_atoms : int, optional
+        Number of atoms, only used if masses is None.
+    positions : (n_atom, 3) Numpy array, optional
+        Geometry in Angstrom, required for get_internal_basis.
+
+    """
+
+    def __init__(self, masses=None, n_atoms=None, positions=None):
+        if masses is None:
+            if n_atoms is None:
+                raise ValueError("Either the masses or the number of atoms are required.")
+            masses = np.ones(n_atoms)
+
+        self.masses = np.asarray(masses, dtype=float)
+        if not np.all(self.masses):
+            raise ValueError("Zero mass encountered in one or more of the atoms.")
+
+        self.atoms = Atoms(numbers=np.ones(len(self.masses)), masses=self.masses,
+                           positions=positions)
+        self.inv_sqrt_masses = self.masses**-0.5
+        self.positions = positions
+
+        self._mass_weights = {}
+        self._scalings = {}
+        self._triangle_indices = {}
+        self._internal_bases = {}
+        self._workspace = threading.local()
+
+    @classmethod
+    def from_hessian(cls, hessian, hes_format, masses=None, positions=None):
+        """
+        Context for the molecule of a Hessian, with the number of atoms taken from the
+        Hessian if no masses are given.
+        """
+        if masses is not None:
+            return cls(masses, positions=positions)
+        return cls(n_atoms=get_n_atoms(hessian, hes_format), positions=positions)
+
+    def get_mass_weights(self, indices=None, dtype=np.float64):
+        """
+        Mass-weighting vector (3n) of the atoms in indices, all atoms by default.
+        """
+        key = (_indices_key(indices), np.dtype(dtype))
+        if key not in self._mass_weights:
+            inv_sqrt_masses = self.inv_sqrt_masses
+            if indices is not None:
+                inv_sqrt_masses = inv_sqrt_masses[indices]
+            self._mass_weights[key] = np.repeat(inv_sqrt_masses, 3).astype(dtype)
+        return self._mass_weights[key]
+
+    def get_scaling(self, indices=None, unit_factor=1., dtype=np.float64):
+        """
+        Mass-weighting vector with the unit conversion folded in, so that
+        scaling * H * scaling is the mass-weighted Hessian in eV A-2 amu-1.
+        """
+        key = (_indices_key(indices), unit_factor, np.dtype(dtype))
+        if key not in self._scalings:
+            scaling = sqrt(unit_factor) * self.get_mass_weights(indices)
+            self._scalings[key] = scaling.astype(dtype)
+        return self._scalings[key]
+
+    def get_triangle_indices(self, n, lower=True):
+        """
+        Row and column indices of the row-major lower or upper triangle of an (n, n) matrix,
+        as np.tril_indices/np.triu_indices but stored in the smallest integer type.
+        """
+        key = (n, lower)
+        if key not in self._triangle_indices:
+            rows, cols = np.tril_indices(n) if lower else np.triu_indices(n)
+            dtype = np.int32 if n < np.iinfo(np.int32).max else np.int64
+            self._triangle_indices[key] = (rows.astype(dtype), cols.astype(dtype))
+        return self._triangle_indices[key]
+
+    def get_internal_basis(self, indices=None):
+        """
+        Internal basis (see hessian.get_internal_basis) of the atoms in indices, all atoms
+        by default. Requires positions.
+        """
+        if self.positions is None:
+            raise ValueError("The internal basis requires the positions of the atoms.")
+
+        key = _indices_key(indices)
+        if key not in self._internal_bases:
+            atoms = self.atoms if indices is None else self.atoms[indices]
+            self._internal_bases[key] = get_internal_basis(atoms)
+        return self._internal_bases[key]
+
+    def get_workspace(self, n, dtype=np.float64):
+        """
+        Fortran-ordered (n, n) buffer for the mass-weighted Hessian, reused by consecutive
+        analyses in the same thread. Its content is overwritten by the next analysis.
+        """
+        workspace = getattr(self._workspace, 'buffer', None)
+        if workspace is None or workspace.shape != (n, n) or workspace.dtype != dtype:
+            workspace = np.empty((n, n), dtype=dtype, order='F')
+            self._workspace.buffer = workspace
+        return workspace
+
+
+def get_n_atoms(hessian, hes_format):
+    """
+    Number of atoms of a Hessian in the given format.
+    """
+    if hes_format in ['upper', 'lower']:
+        n_dofs = int(round((sqrt(8 * len(hessian) + 1) - 1) / 2))
+    else:
+        n_dofs = hessian.shape[0]
+    return -(-n_dofs // 3)
+
+
+def _indices_key(indices):
+    return None if indices is None else tuple(np.asarray(indices).tolist())
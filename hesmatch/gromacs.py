@@ -0,0 +1,72 @@
+"""
+Reader of the binary Hessian files (.mtx) of GROMACS (mdrun -nm, gmx nmeig), which are
+in kJ mol-1 nm-2 (unit 2).
+
+The files are big-endian XDR, as written by gmx_mtxio_write: the magic number
+0x34ce8fd2, the GROMACS version (int length + 1, then an XDR string of uint length and
+padded bytes), the precision (int, 0: single, 1: double, which sets the size of the
+reals), the number of rows and columns (int), and the storage (int, 0: full,
+1: sparse). A full matrix follows as nrow * ncol reals. A sparse matrix follows as
+compressed_symmetric (int bool, only one triangle stored), nrow (int), the number of
+entries of each row (nrow ints) and the entries of all rows as (int column, real value).
+"""
+import numpy as np
+from scipy.sparse import coo_matrix
+
+MTX_MAGIC = 0x34ce8fd2
+MTX_FULL_MATRIX = 0
+MTX_SPARSE_MATRIX = 1
+# Data type of the reals by the precision field
+MTX_REALS = {0: np.dtype('>f4'), 1: np.dtype('>f8')}
+
+
+def read_mtx(file, dtype=float):
+    """
+    Hessian of a GROMACS .mtx file (path or binary stream), as an (nrow, ncol) Numpy array
+    for full storage or as a scipy.sparse coo_matrix for sparse storage, in kJ mol-1 nm-2.
+    """
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            return read_mtx(f, dtype)
+
+    if _read_ints(file, 1)[0] != MTX_MAGIC:
+        raise ValueError("Not a GROMACS .mtx file.")
+    _read_ints(file, 1)  # Length of the version string + 1
+    version_size = _read_ints(file, 1, '>u4')[0]
+    _read(file, -(-version_size // 4) * 4)
+
+    precision, nrow, ncol, storage = _read_ints(file, 4)
+    if precision not in MTX_REALS:
+        raise ValueError(f"Unknown precision {precision} in the .mtx file.")
+    real = MTX_REALS[precision]
+
+    if storage == MTX_FULL_MATRIX:
+        values = np.frombuffer(_read(file, nrow * ncol * real.itemsize), dtype=real)
+        return values.reshape(nrow, ncol).astype(dtype)
+    elif storage != MTX_SPARSE_MATRIX:
+        raise ValueError(f"Unknown storage type {storage} in the .mtx file.")
+
+    compressed_symmetric, nrow = _read_ints(file, 2)
+    ndata = _read_ints(file, nrow)
+    record = np.dtype([('col', '>i4'), ('value', real)])
+    entries = np.frombuffer(_read(file, int(ndata.sum()) * record.itemsize), dtype=record)
+
+    rows = np.repeat(np.arange(nrow), ndata)
+    cols = entries['col'].astype(np.int64)
+    values = entries['value'].astype(dtype)
+    if compressed_symmetric:
+        off_diagonal = rows != cols
+        rows, cols = np.append(rows, cols[off_diagonal]), np.append(cols, rows[off_diagonal])
+        values = np.append(values, values[off_diagonal])
+    return coo_matrix((values, (rows, cols)), shape=(nrow, ncol), dtype=dtype)
+
+
+def _read_ints(file, count, dtype='>i4'):
+    return np.frombuffer(_read(file, 4 * count), dtype=dtype).astype(np.int64)
+
+
+def _read(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise ValueError("Unexpected end of the .mtx file.")
+    return data
@@ -1,21 +1,52 @@
+from collections import deque
+import hashlib
+import warnings
 from ase import Atoms
 import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix, issparse
 from ase.units import Hartree, mol, kJ, Bohr, nm
-from .hessian import VibrationsData
-from .matching import matcher
+from .cache import DiskCache
+from .context import AnalysisContext
+from .hessian import VibrationsData, get_partial_hessian, triangle_to_2d
+from .journal import Journal, hash_hessian
+from .matching import _get_vibrations, match_to_reference, matcher
+from .pipeline import map_ordered
+from .scheduler import (can_limit_blas_threads, check_blas_threads, limit_blas_threads,
+                        plan_workers)
+from .shared import match_in_processes
+
+# Supported Hessian units
+KJ_MOL_A2 = 1
+KJ_MOL_NM2 = 2
+HARTREE_BOHR2 = 3
+
+# Conversion of the supported Hessian units to eV A-2
+UNIT_FACTORS = {
+    KJ_MOL_A2: kJ / mol,
+    KJ_MOL_NM2: kJ / mol / nm**2,
+    HARTREE_BOHR2: Hartree / Bohr**2,
+}
+
+# Rigid-body contamination (see hessian.VibrationsData.get_rigid_body_contamination)
+# above which the Hessian is not taken to be at a stationary point
+RIGID_CONTAMINATION_TOL = 1e-3
 
 def hesmatch(ref_hessian, match_hessians, masses=None, ref_format='2d', match_format='2d',
-             ref_unit=1, match_unit=1):
+             ref_unit=1, match_unit=1, degenerate_tol=None, positions=None, indices=None,
+             subset_method='extract', fragments=False, n_modes=None, target_freq=None,
+             precision='double', refine=False, n_jobs=1, n_procs=None,
+             blas_threads=None, journal=None, cache=None):
     """
 
     Parameters
     ----------
     ref_hessian : TYPE
         DESCRIPTION.
-    match_hessians : TYPE
-        DESCRIPTION.
+    match_hessians : iterable of Numpy arrays
+        Consumed one Hessian at a time, each is analysed, matched and released before
+        the next one is taken, so a generator keeps the memory use flat.
     masses : TYPE, optional
-        DESCRIPTION. The default is None.
+        DESCRIPTION. The default is None, which sets all masses to 1.
     ref_format : TYPE, optional
         DESCRIPTION. The default is '2d'.
     match_format : TYPE, optional
@@ -24,6 +55,54 @@ def hesmatch(ref_hessian, match_hessians, masses=None, ref_format='2d', match_fo
         DESCRIPTION. The default is 1.
     match_unit : TYPE, optional
         DESCRIPTION. The default is 1.
+    degenerate_tol : float, optional
+        Frequency gap (cm-1) below which modes are matched as degenerate subspaces.
+        The default is None, which matches every mode individually.
+    positions : (n_atom, 3) Numpy array, optional
+        Reference geometry in Angstrom. If given, the rigid-body modes are projected
+        out exactly and the Hessians are diagonalized in the 3N-6 (3N-5) dimensional
+        internal space. The default is None, which drops the lowest modes, as many as
+        there are rigid-body modes (see hessian.VibrationsData.get_n_rigid).
+    indices : sequence of int, optional
+        Atoms to restrict the analysis and matching to, in any order but without repeats.
+        The default is None, all atoms.
+    subset_method : str, optional
+        How the rest of the system enters the Hessian of the subset, see
+        hessian.get_partial_hessian. The default is 'extract', i.e. a frozen environment.
+    fragments : bool, optional
+        Diagonalize the Hessians of non-interacting fragments separately. The default is False.
+    n_modes : int, optional
+        Only compute and match this many modes, the ones closest to target_freq. The default
+        is None, all modes.
+    target_freq : float, optional
+        Frequency (cm-1) around which the n_modes modes are computed.
+    precision : str, optional
+        'single' to run the analyses in float32. The default is 'double'.
+    refine : bool, optional
+        Refine the frequencies of single precision analyses in float64 and print the
+        largest frequency error bound of each match after its result (see
+        hessian.VibrationsData.get_frequency_error_bound). The default is False.
+    n_jobs : int, optional
+        Number of threads analysing the match Hessians ahead of the matching. The default
+        is 1, which analyses them one after the other; None uses all CPUs.
+    n_procs : int, optional
+        Number of worker processes analysing and matching the match Hessians, which are
+        passed to them through shared memory together with the reference modes. The
+        default is None, which analyses and matches them in this process. 'auto' sizes the
+        process pool from the size of the Hessian and the number of CPUs, see
+        scheduler.plan_workers.
+    blas_threads : int, optional
+        Number of BLAS threads per process, requires threadpoolctl. The default is None,
+        which splits the CPUs between the processes if n_procs is given and threadpoolctl
+        is installed, and else leaves it to the BLAS library.
+    journal : str, optional
+        Path of a journal (see journal.Journal) that records the result of every match as
+        soon as it is done. Matches already recorded by an interrupted run with the same
+        reference and settings are skipped. The default is None, no journal.
+    cache : str or cache.DiskCache, optional
+        Directory of a persistent cache of the vibrational analyses and the matching
+        results, keyed by the content of the Hessians and the settings, which may be
+        shared by concurrent runs. The default is None, no cache.
 
     Returns
     -------
@@ -31,30 +110,301 @@ def hesmatch(ref_hessian, match_hessians, masses=None, ref_format='2d', match_fo
 
 
     """
+    check_blas_threads(blas_threads)
+    indices = _sort_indices(indices)
+
+    context = AnalysisContext.from_hessian(ref_hessian, ref_format, masses, positions)
+
+    internal_basis = None
+    if positions is not None and (indices is None or subset_method == 'schur'):
+        internal_basis = context.get_internal_basis(indices)
+
+    if isinstance(cache, str):
+        cache = DiskCache(cache)
+
+    if n_procs == 'auto' or (n_procs is not None and blas_threads is None):
+        n_dofs = 3 * (len(context.atoms) if indices is None else len(indices))
+        n_procs, planned_threads = plan_workers(n_dofs, n_procs=None if n_procs == 'auto'
+                                                else n_procs, blas_threads=blas_threads)
+        if blas_threads is None:
+            if can_limit_blas_threads():
+                blas_threads = planned_threads
+            else:
+                warnings.warn('threadpoolctl is not installed, the BLAS threads of the '
+                              'worker processes are not limited.')
+
+    with limit_blas_threads(blas_threads):
+        ref = do_vibrational_analysis(ref_hessian, ref_format, ref_unit, masses, positions,
+                                      internal_basis, indices, subset_method, fragments,
+                                      n_modes, target_freq, precision, refine, context, cache)
+        ref_freqs, ref_modes = _get_vibrations(ref)
+    # The matches drop as many rigid-body modes as the reference, whatever their spectrum
+    n_rigid = ref.get_n_rigid()
+
+    load_result = None
+    if journal is not None or cache is not None:
+        settings = [ref_format, match_format, ref_unit, match_unit, degenerate_tol,
+                    subset_method, fragments, n_modes, target_freq, precision, refine]
+        settings += [None if array is None else np.asarray(array).tolist()
+                     for array in (masses, positions, indices)]
+        settings = hashlib.sha256(repr(settings).encode()).hexdigest()
+        ref_key = hash_hessian(ref_hessian, UNIT_FACTORS.get(ref_unit, 1.))
+    if journal is not None:
+        journal = Journal(journal, {'ref': ref_key, 'settings': settings})
+    if cache is not None:
+        def load_result(key):
+            result = cache.get(cache.make_key('match', ref_key, settings, key))
+            if result is not None:
+                error_bound = result.get('error_bound')
+                return ((result['chosen_overlaps'], result['diff'], result['error']),
+                        None if error_bound is None else float(error_bound))
+
+    # Only the first of identical match Hessians is analysed and matched, the entries of
+    # order tell which results to reuse for the others
+    order = deque()
+    unique_results = {}
+    match_hessians = _unique_hessians(match_hessians, UNIT_FACTORS.get(match_unit, 1.),
+                                      journal, order, unique_results, load_result)
+
+    if n_procs is not None:
+        analysis = dict(hes_format=match_format, unit=match_unit, masses=masses,
+                        positions=positions, internal_basis=internal_basis, indices=indices,
+                        subset_method=subset_method, fragments=fragments, n_modes=n_modes,
+                        target_freq=target_freq, precision=precision, refine=refine,
+                        cache=cache, n_rigid=n_rigid)
+        results = match_in_processes(ref, match_hessians, analysis, degenerate_tol, n_procs,
+                                     blas_threads)
+    else:
+        def analyse(match_hessian):
+            match = do_vibrational_analysis(match_hessian, match_format, match_unit, masses,
+                                            positions, internal_basis, indices, subset_method,
+                                            fragments, n_modes, target_freq, precision,
+                                            refine, context, cache, n_rigid)
+            # Diagonalize here, i.e. in the worker thread with n_jobs
+            match.get_energies_and_modes()
+            return match, _get_error_bound(match)
+
+        if n_jobs == 1:
+            matches = (analyse(match_hessian) for match_hessian in match_hessians)
+        else:
+            matches = map_ordered(analyse, match_hessians, n_jobs)
+
+        results = ((match_to_reference(ref_freqs, ref_modes, match, degenerate_tol),
+                    error_bound) for match, error_bound in matches)
+
+    def report(output, index, key, unique):
+        result, error_bound = output
+        print(*result)
+        if error_bound is not None:
+            print(f'Frequency error bound: {error_bound:.3e} cm-1')
+        if unique:
+            unique_results[key] = output
+            if cache is not None:
+                chosen_overlaps, diff, error = result
+                bound = {} if error_bound is None else {'error_bound': error_bound}
+                cache.put(cache.make_key('match', ref_key, settings, key),
+                          chosen_overlaps=chosen_overlaps, diff=diff, error=error, **bound)
+        if journal is not None:
+            journal.record(key, result, index)
+
+    try:
+        with limit_blas_threads(blas_threads):
+            for output in results:
+                index, key, unique = order.popleft()
+                while not unique:
+                    report(unique_results[key], index, key, unique)
+                    index, key, unique = order.popleft()
+                report(output, index, key, unique)
+            for index, key, _ in order:
+                report(unique_results[key], index, key, False)
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+def _unique_hessians(match_hessians, unit_factor, journal, order, known_results,
+                     load_result=None):
+    """
+    Yield the match Hessians that are not in the journal, not identical to an earlier one
+    after the unit conversion and whose result is not known or loaded by load_result into
+    known_results. The position, the hash and whether it is yielded are queued in order
+    for all but the ones journaled at their position. The result of a Hessian journaled
+    only at other positions by an earlier run is taken from the journal.
+    """
+    seen = set()
+    for index, hessian in enumerate(match_hessians):
+        key = hash_hessian(hessian, unit_factor)
+        if journal is not None and key in journal:
+            if journal.is_recorded(key, index):
+                continue
+            if key not in seen and key not in known_results:
+                # Journaled at other positions by an earlier run
+                known_results[key] = (journal.get_result(key), None)
+        if key not in seen and key not in known_results and load_result is not None:
+            result = load_result(key)
+            if result is not None:
+                known_results[key] = result
+        unique = key not in seen and key not in known_results
+        order.append((index, key, unique))
+        if unique:
+            seen.add(key)
+            yield hessian
+
+
+def _sort_indices(indices):
+    """
+    Atom indices of a subset in ascending order, the order of the atoms in the analysis.
+    """
+    if indices is None:
+        return None
+    sorted_indices = np.unique(indices)
+    if len(sorted_indices) != len(indices):
+        raise ValueError("The atom indices of the subset must not repeat.")
+    return sorted_indices
+
 
-    ref = do_vibrational_analysis(ref_hessian, ref_format, ref_unit, masses)
-    matches = [do_vibrational_analysis(match_hessian, match_format, match_unit, masses)
+def hesmatch_isotopologues(ref_hessian, match_hessians, mass_sets, ref_format='2d',
+                           match_format='2d', ref_unit=1, match_unit=1, degenerate_tol=None,
+                           positions=None, precision='double', batch_size=None):
+    """
+    Match the isotopologues given by a set of masses each, using the same Cartesian Hessians.
+    The Hessians are read and converted once, and the mass-weighted eigenproblems of all
+    isotopologues are solved as stacks. The match Hessians of each isotopologue are matched
+    against the reference Hessian of the same isotopologue.
+
+    Parameters
+    ----------
+    ref_hessian : Numpy array
+    match_hessians : list of Numpy arrays
+    mass_sets : (n_isotopologue, n_atom) Numpy array
+    ref_format, match_format, ref_unit, match_unit, degenerate_tol, positions, precision :
+        See hesmatch.
+    batch_size : int, optional
+        Number of isotopologues diagonalized in one stack. The default is None, all of them.
+
+    Returns
+    -------
+    None.
+
+    """
+    mass_sets = np.atleast_2d(np.asarray(mass_sets, dtype=float))
+
+    refs = do_isotopologue_analysis(ref_hessian, ref_format, ref_unit, mass_sets, positions,
+                                    precision, batch_size)
+    matches = [do_isotopologue_analysis(match_hessian, match_format, match_unit, mass_sets,
+                                        positions, precision, batch_size)
                for match_hessian in match_hessians]
 
-    matcher(ref, matches)
+    for i, ref in enumerate(refs):
+        print(f'Isotopologue {i}')
+        matcher(ref, [match[i] for match in matches], degenerate_tol)
+
 
+def do_isotopologue_analysis(hessian, hes_format, unit, mass_sets, positions=None,
+                             precision='double', batch_size=None):
+    n_atoms = mass_sets.shape[1]
+    molecule = Atoms(numbers=np.ones(n_atoms), masses=mass_sets[0], positions=positions)
 
-def do_vibrational_analysis(hessian, hes_format, unit, masses):
-    n_atoms = len(masses)
-    molecule = Atoms(numbers=np.ones(n_atoms), masses=masses)
+    if hes_format in ['upper', 'lower']:
+        hessian = triangle_to_2d(hessian, lower=(hes_format == 'lower'))
+    elif hes_format == 'sparse' or issparse(hessian):
+        hessian = coo_matrix(hessian)
+        hessian = csr_matrix((hessian.data, (hessian.row, hessian.col)),
+                             shape=(3 * n_atoms, 3 * n_atoms)).toarray()
 
-    if unit == 1:  # kJ mol-1 A-2 to eV A-2
-        hessian *= kJ / mol
-    if unit == 2:  # kJ mol-1 nm-2 to eV A-2
-        hessian *= kJ / mol / nm**2
-    elif unit == 3:  # Hartree Bohr-2 to eV A-2
-        hessian *= Hartree / Bohr**2
+    return VibrationsData.from_2d_isotopologues(molecule, hessian, mass_sets,
+                                                project_rigid=positions is not None,
+                                                batch_size=batch_size, precision=precision,
+                                                unit_factor=UNIT_FACTORS.get(unit, 1.))
 
-    if hes_format == '2d':
-        vib_data = VibrationsData.from_2d(molecule, hessian)
+
+def do_vibrational_analysis(hessian, hes_format, unit, masses, positions=None,
+                            internal_basis=None, indices=None, subset_method='extract',
+                            fragments=False, n_modes=None, target_freq=None,
+                            precision='double', refine=False, context=None, cache=None,
+                            n_rigid=None):
+    indices = _sort_indices(indices)
+    if hes_format == '2d' and issparse(hessian):
+        # Full matrix files may come in sparse storage, e.g. GROMACS .mtx
+        hes_format = 'sparse'
+    if context is None:
+        context = AnalysisContext.from_hessian(hessian, hes_format, masses, positions)
+    if cache is not None:
+        key = cache.make_key('analysis', hash_hessian(hessian, UNIT_FACTORS.get(unit, 1.)),
+                             hes_format, context.masses, positions, internal_basis is not None,
+                             indices, subset_method, fragments, n_modes, target_freq,
+                             precision, refine)
+    molecule = context.atoms
+    n_atoms = len(molecule)
+    vib_kwargs = dict(internal_basis=internal_basis, fragments=fragments, n_modes=n_modes,
+                      target_freq=target_freq, precision=precision,
+                      unit_factor=UNIT_FACTORS.get(unit, 1.), context=context,
+                      n_rigid=n_rigid)
+
+    if precision == 'single' and not refine:
+        # With refine, the analysis rounds its own copy and the input is kept for refining
+        hessian = hessian.astype(np.float32, copy=False)
+
+    if hes_format == 'sparse':
+        hessian = coo_matrix(hessian)
+        hessian = csr_matrix((hessian.data, (hessian.row, hessian.col)),
+                             shape=(3 * n_atoms, 3 * n_atoms))
+
+    if indices is not None:
+        if hes_format in ['upper', 'lower']:
+            lower = hes_format == 'lower'
+            hessian = triangle_to_2d(hessian, lower,
+                                     context.get_triangle_indices(3 * n_atoms, lower))
+        hessian = get_partial_hessian(hessian, indices, subset_method)
+        if subset_method == 'extract':
+            n_rigid = 0
+        if issparse(hessian):
+            vib_data = VibrationsData.from_sparse(molecule, hessian, indices=indices,
+                                                  **vib_kwargs)
+        else:
+            vib_data = VibrationsData.from_2d(molecule, hessian, indices=indices,
+                                              **vib_kwargs)
+    elif hes_format == '2d':
+        vib_data = VibrationsData.from_2d(molecule, hessian, **vib_kwargs)
     elif hes_format == 'upper':
-        vib_data = VibrationsData.from_upper_triangle(molecule, hessian)
+        vib_data = VibrationsData.from_upper_triangle(molecule, hessian, **vib_kwargs)
     elif hes_format == 'lower':
-        vib_data = VibrationsData.from_lower_triangle(molecule, hessian)
+        vib_data = VibrationsData.from_lower_triangle(molecule, hessian, **vib_kwargs)
+    elif hes_format == 'sparse':
+        vib_data = VibrationsData.from_sparse(molecule, hessian, **vib_kwargs)
+
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            vib_data.set_energies_and_modes(cached['energies'], cached['modes'],
+                                            cached.get('frequency_error_bound'))
+            return vib_data
+
+    if internal_basis is not None:
+        contamination = vib_data.get_rigid_body_contamination()
+        if contamination > RIGID_CONTAMINATION_TOL:
+            warnings.warn(f'Rigid-body contamination of {contamination:.3e}, the Hessian may '
+                          'not be at a stationary point.')
+
+    if refine:
+        # The error bound is kept, see VibrationsData.get_frequency_error_bound
+        vib_data.refine_frequencies(hessian=hessian)
+
+    if cache is not None:
+        energies, modes = vib_data.get_energies_and_modes()
+        error_bound = vib_data.get_frequency_error_bound()
+        bound = {} if error_bound is None else {'frequency_error_bound': error_bound}
+        cache.put(key, energies=energies, modes=modes, **bound)
 
     return vib_data
+
+
+def _get_error_bound(vib_data):
+    """
+    Largest frequency error bound (cm-1) of the vibrational modes of a refined analysis,
+    or None if it was not refined.
+    """
+    error_bound = vib_data.get_frequency_error_bound()
+    if error_bound is None:
+        return None
+    return float(np.nanmax(error_bound[vib_data.get_n_rigid():]))
@@ -1,16 +1,239 @@
-from typing import Sequence, Union
+from typing import List, Sequence, Tuple, Union
 from numbers import Real
+from math import sqrt
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from scipy.linalg import eigh, get_lapack_funcs
+from scipy.sparse import coo_matrix, csr_matrix, diags, issparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import eigsh, spsolve
 from ase.vibrations import VibrationsData
-from ase import Atoms
+from ase import Atoms, units
+
+# sqrt of the eigenvalues of the mass-weighted Hessian in eV A-2 amu-1 to eV
+ENERGY_CONVERSION = units._hbar * units.m / sqrt(units._e * units._amu)
 
 
 class VibrationsData(VibrationsData):
 
+    def __init__(self, atoms: Atoms,
+                 hessian: Union[Sequence[Sequence[Real]], np.ndarray],
+                 indices: Sequence[int] = None,
+                 internal_basis: np.ndarray = None,
+                 n_rigid: int = None,
+                 fragments: bool = False,
+                 n_modes: int = None,
+                 target_freq: float = None,
+                 packed: str = None,
+                 precision: str = 'double',
+                 unit_factor: float = 1.,
+                 context=None) -> None:
+        """Vibrational data of ase.vibrations.VibrationsData, with the
+        diagonalization done once and cached
+
+        Args:
+            atoms: Equilibrium geometry of vibrating system
+
+            hessian: Second-derivative in energy with respect to
+                Cartesian nuclear movements as an (N, 3, N, 3) array. A (3N, 3N)
+                array, a (3N, 3N) scipy.sparse matrix or a packed triangle (see
+                packed) is kept as given, without a copy if it already has the
+                dtype of precision. It is never modified.
+
+            indices: Indices of (non-frozen) atoms included in Hessian
+
+            internal_basis: Orthonormal (3N, 3N-6) basis of the mass-weighted
+                internal space, see get_internal_basis(). If given, the Hessian
+                is projected on it before diagonalization so that the
+                rigid-body modes are removed exactly.
+
+            n_rigid: Number of leading rigid-body modes, see get_n_rigid()
+
+            fragments: Diagonalize the Hessian of each group of atoms that
+                does not couple to the rest of the system separately, see
+                find_fragments(). Each fragment has its own rigid-body modes,
+                see get_n_rigid(). Not used together with an internal basis.
+
+            n_modes: Only compute this many modes, the ones closest to
+                target_freq, with a shift-invert Lanczos solver (eigsh).
+
+            target_freq: Frequency in cm-1 around which the n_modes modes are
+                computed. Required if n_modes is given.
+
+            packed: 'lower' or 'upper' if the Hessian is the row-major lower
+                or upper triangle in ((3N)**2+3N)/2 format. It is kept packed
+                until it is expanded into the buffer of the eigensolver.
+
+            precision: 'single' to store and diagonalize the Hessian in
+                float32, see refine_frequencies(), or 'double' (float64).
+
+            unit_factor: Factor that converts the Hessian to eV A-2. It is
+                folded into the mass-weighting, so the conversion costs no
+                extra pass over the Hessian.
+
+            context: AnalysisContext of the molecule, whose atoms, mass-weighting
+                vectors, triangle indices and workspace are used instead of
+                per-analysis copies.
+
+        """
+        self._dtype = np.float32 if precision == 'single' else np.float64
+        if issparse(hessian):
+            hessian = hessian.astype(self._dtype, copy=False)
+        else:
+            hessian = np.asarray(hessian, dtype=self._dtype)
+
+        self._unit_factor = unit_factor
+        self._context = context
+        self._hessian2d = None
+        self._sparse_hessian = None
+        self._packed_hessian = None
+        self._packed_lower = packed == 'lower'
+
+        if issparse(hessian) or packed is not None or hessian.ndim == 2:
+            # Keep the Hessian as given instead of the dense copy made by ASE
+            if indices is None:
+                indices = range(len(atoms))
+            self._indices = np.array(indices, dtype=int)
+            self._atoms = atoms.copy() if context is None else context.atoms
+            if packed is not None:
+                self._check_dimensions(atoms, hessian, indices=self._indices, triangle=True)
+                self._packed_hessian = hessian
+            elif issparse(hessian):
+                self._check_dimensions(atoms, hessian, indices=self._indices, two_d=True)
+                self._sparse_hessian = csr_matrix(hessian)
+            else:
+                self._check_dimensions(atoms, hessian, indices=self._indices, two_d=True)
+                self._hessian2d = hessian
+        else:
+            super().__init__(atoms, hessian, indices=indices)
+
+        if n_modes is not None and target_freq is None:
+            raise ValueError("A target frequency is required to compute n_modes modes.")
+        self._n_modes = n_modes
+        self._target_freq = target_freq
+        self._internal_basis = internal_basis
+        self._n_rigid = n_rigid
+        self._fragments = fragments
+        self._fragment_dofs = None
+        self._energies_and_modes_cache = None
+        self._frequency_error_bound = None
+
+    @classmethod
+    def from_2d(cls, atoms: Atoms,
+                hessian_2d: Union[Sequence[Sequence[Real]], np.ndarray],
+                indices: Sequence[int] = None,
+                **kwargs) -> 'VibrationsData':
+        """Instantiate VibrationsData when the Hessian is in a 3Nx3N format
+
+        Args:
+            atoms: Equilibrium geometry of vibrating system
+
+            hessian: Second-derivative in energy with respect to
+                Cartesian nuclear movements as a (3N, 3N) array.
+
+            indices: Indices of (non-frozen) atoms included in Hessian
+
+            kwargs: Passed on to VibrationsData()
+
+        """
+        if indices is None:
+            indices = range(len(atoms))
+        assert indices is not None  # Show Mypy that indices is now a sequence
+
+        hessian_2d_array = np.asarray(hessian_2d)
+        cls._check_dimensions(atoms, hessian_2d_array,
+                              indices=indices, two_d=True)
+
+        return cls(atoms, hessian_2d_array, indices=indices, **kwargs)
+
+    @classmethod
+    def from_2d_isotopologues(cls, atoms: Atoms,
+                              hessian_2d: Union[Sequence[Sequence[Real]], np.ndarray],
+                              mass_sets: np.ndarray,
+                              project_rigid: bool = False,
+                              batch_size: int = None,
+                              **kwargs) -> List['VibrationsData']:
+        """Instantiate one VibrationsData per set of masses for the same
+        Hessian in a 3Nx3N format, with the mass-weighted eigenproblems
+        solved together as stacks in single eigh calls
+
+        Args:
+            atoms: Equilibrium geometry of vibrating system
+
+            hessian: Second-derivative in energy with respect to
+                Cartesian nuclear movements as a (3N, 3N) array.
+
+            mass_sets: (K, N) array with the masses of each isotopologue
+
+            project_rigid: Project out the rigid-body modes with the internal
+                basis of each isotopologue, which requires the positions of
+                the atoms
+
+            batch_size: Number of eigenproblems per stack, which bounds the
+                memory to batch_size mass-weighted Hessians. Default is all K.
+
+            kwargs: Passed on to VibrationsData(), only precision and
+                unit_factor are supported
+
+        """
+        vib_list = []
+        for masses in mass_sets:
+            isotopologue = atoms.copy()
+            isotopologue.set_masses(masses)
+            internal_basis = get_internal_basis(isotopologue) if project_rigid else None
+            vib_list.append(cls.from_2d(isotopologue, hessian_2d, internal_basis=internal_basis,
+                                        **kwargs))
+
+        if batch_size is None:
+            batch_size = len(vib_list)
+
+        for start in range(0, len(vib_list), batch_size):
+            batch = vib_list[start:start + batch_size]
+            hessian = batch[0]._get_raw_hessian_2d()
+            scalings = np.array([vib._get_hessian_scaling() for vib in batch])
+            hessians = scalings[:, :, np.newaxis] * hessian * scalings[:, np.newaxis, :]
+
+            if project_rigid:
+                bases = np.array([vib._internal_basis for vib in batch], dtype=hessians.dtype)
+                hessians = np.swapaxes(bases, 1, 2) @ hessians @ bases
+                omega2, vectors = np.linalg.eigh(hessians)
+                vectors = bases @ vectors
+            else:
+                omega2, vectors = np.linalg.eigh(hessians)
+            del hessians
+
+            for vib, vib_omega2, vib_vectors in zip(batch, omega2, vectors):
+                vib._energies_and_modes_cache = vib._to_energies_and_modes(vib_omega2,
+                                                                           vib_vectors)
+
+        return vib_list
+
+    @classmethod
+    def from_sparse(cls, atoms: Atoms, hessian_sparse,
+                    indices: Sequence[int] = None,
+                    **kwargs) -> 'VibrationsData':
+        """Instantiate VibrationsData when the Hessian is a 3Nx3N
+        scipy.sparse matrix, which is kept sparse through mass-weighting
+        and, with n_modes, a partial diagonalization
+
+        Args:
+            atoms: Equilibrium geometry of vibrating system
+
+            hessian: Second-derivative in energy with respect to
+                Cartesian nuclear movements as a (3N, 3N) sparse matrix.
+
+            indices: Indices of (non-frozen) atoms included in Hessian
+
+            kwargs: Passed on to VibrationsData()
+
+        """
+        return cls(atoms, csr_matrix(hessian_sparse), indices=indices, **kwargs)
+
     @classmethod
     def from_lower_triangle(cls, atoms: Atoms,
                 hessian_lower_triangle: Union[Sequence[Sequence[Real]], np.ndarray],
-                indices: Sequence[int] = None) -> 'VibrationsData':
+                indices: Sequence[int] = None,
+                **kwargs) -> 'VibrationsData':
         """Instantiate VibrationsData when the Hessian is given as the
         lower triangle of the matrix in ((3N)**2+3N)/2 format
 
@@ -22,31 +245,25 @@ class VibrationsData(VibrationsData):
 
             indices: Indices of (non-frozen) atoms included in Hessian
 
+            kwargs: Passed on to VibrationsData()
+
         """
         if indices is None:
             indices = range(len(atoms))
         assert indices is not None  # Show Mypy that indices is now a sequence
 
         hessian_lower_triangle_array = np.asarray(hessian_lower_triangle)
-        n_atoms = cls._check_dimensions(atoms, hessian_lower_triangle_array,
-                                        indices=indices, triangle=True)
-
-        hessian_2d_array = np.zeros((3*n_atoms, 3*n_atoms))
-
-        count = 0
-        for i in range(3*n_atoms):
-            for j in range(i+1):
-                hessian_2d_array[i, j] = hessian_lower_triangle_array[count]
-                hessian_2d_array[j, i] = hessian_2d_array[i, j]
-                count += 1
+        cls._check_dimensions(atoms, hessian_lower_triangle_array,
+                              indices=indices, triangle=True)
 
-        return cls(atoms, hessian_2d_array.reshape(n_atoms, 3, n_atoms, 3),
-                   indices=indices)
+        return cls(atoms, hessian_lower_triangle_array, indices=indices, packed='lower',
+                   **kwargs)
 
     @classmethod
     def from_upper_triangle(cls, atoms: Atoms,
                 hessian_upper_triangle: Union[Sequence[Sequence[Real]], np.ndarray],
-                indices: Sequence[int] = None) -> 'VibrationsData':
+                indices: Sequence[int] = None,
+                **kwargs) -> 'VibrationsData':
         """Instantiate VibrationsData when the Hessian is given as the
         upper triangle of the matrix in ((3N)**2+3N)/2 format
 
@@ -58,26 +275,328 @@ class VibrationsData(VibrationsData):
 
             indices: Indices of (non-frozen) atoms included in Hessian
 
+            kwargs: Passed on to VibrationsData()
+
         """
         if indices is None:
             indices = range(len(atoms))
         assert indices is not None  # Show Mypy that indices is now a sequence
 
         hessian_upper_triangle_array = np.asarray(hessian_upper_triangle)
-        n_atoms = cls._check_dimensions(atoms, hessian_upper_triangle_array,
-                                        indices=indices, triangle=True)
+        cls._check_dimensions(atoms, hessian_upper_triangle_array,
+                              indices=indices, triangle=True)
+
+        return cls(atoms, hessian_upper_triangle_array, indices=indices, packed='upper',
+                   **kwargs)
+
+    def get_energies_and_modes(self, all_atoms: bool = False
+                               ) -> Tuple[np.ndarray, np.ndarray]:
+        """Diagonalise the Hessian to obtain harmonic modes
 
-        hessian_2d_array = np.zeros((3*n_atoms, 3*n_atoms))
+        Results are cached so diagonalization will only be performed once for
+        this object instance.
 
-        count = 0
-        for i in range(3*n_atoms):
-            for j in range(i, 3*n_atoms):
-                hessian_2d_array[i, j] = hessian_upper_triangle_array[count]
-                hessian_2d_array[j, i] = hessian_2d_array[i, j]
-                count += 1
+        Args:
+            all_atoms: If True, return modes as (3N, [N + N_frozen], 3) array
+                where the second axis corresponds to the full list of atoms in
+                the attached atoms object. Atoms that were not included in the
+                Hessian will have displacement vectors of (0, 0, 0).
 
-        return cls(atoms, hessian_2d_array.reshape(n_atoms, 3, n_atoms, 3),
-                   indices=indices)
+        Returns:
+            Tuple of (energies, modes). Energies are given in units of eV and
+            modes in Cartesian coordinates as a (n_modes, N, 3) array, where
+            n_modes is 3N, or 3N minus the rigid-body modes if an internal
+            basis is used.
+
+        """
+        if self._energies_and_modes_cache is None:
+            self._energies_and_modes_cache = self._calc_energies_and_modes()
+        energies, modes_from_hessian = self._energies_and_modes_cache
+
+        if all_atoms:
+            n_all_atoms = len(self._atoms)
+            modes = np.zeros((len(modes_from_hessian), n_all_atoms, 3))
+            modes[:, self.get_mask(), :] = modes_from_hessian
+        else:
+            modes = modes_from_hessian.copy()
+
+        return energies.copy(), modes
+
+    def get_hessian(self) -> np.ndarray:
+        """The Hessian in eV A-2 as an (N, 3, N, 3) array"""
+        hessian_2d = self.get_hessian_2d()
+        n_atoms = len(hessian_2d) // 3
+        return hessian_2d.reshape(n_atoms, 3, n_atoms, 3)
+
+    def get_hessian_2d(self) -> np.ndarray:
+        """The Hessian in eV A-2 as a (3N, 3N) array, also for sparse or
+        packed input"""
+        if self._hessian2d is not None:
+            return self._hessian2d * self._dtype(self._unit_factor)
+        hessian_2d = self._get_raw_hessian_2d()
+        hessian_2d *= self._unit_factor
+        return hessian_2d
+
+    def get_n_rigid(self) -> int:
+        """Number of leading modes that belong to rigid-body motion
+
+        Without an internal basis the lowest modes are taken to be the
+        translations and rotations, unless set otherwise on creation, e.g.
+        for a partial Hessian with a frozen environment. Their number is the
+        rank of the rigid-body basis of the geometry (5 for linear
+        molecules), see get_rigid_body_basis(), summed over the fragments if
+        they are diagonalized separately. Without a geometry (all atoms at
+        the same position) it is 6, 5 for two atoms and 3 for a single atom,
+        so that it is the same for all Hessians of the same system. With an
+        internal basis, they are projected out
+        exactly and none of the returned modes are rigid-body modes. Neither
+        are they for a partial spectrum around a target frequency.
+
+        """
+        if self._internal_basis is not None or self._n_modes is not None:
+            return 0
+        if self._n_rigid is not None:
+            return self._n_rigid
+
+        atoms = self._atoms[self.get_mask()]
+        if self._fragments:
+            groups = [dofs[::3] // 3 for dofs in self._get_fragments()]
+        else:
+            groups = [np.arange(len(atoms))]
+
+        if np.ptp(atoms.get_positions(), axis=0).any():
+            return sum(get_rigid_body_basis(atoms[group]).shape[1] for group in groups)
+        return sum(_get_rigid_count(len(group)) for group in groups)
+
+    def get_rigid_body_contamination(self) -> float:
+        """Relative size of the coupling of the mass-weighted Hessian to
+        rigid-body motion, ||H R|| / ||H|| with the orthonormal rigid-body
+        basis R of get_rigid_body_basis(), which equals ||H P|| / ||H|| for
+        the projector P = R R^T on the rigid-body space. This is zero for a
+        Hessian at a stationary point that obeys translational and
+        rotational invariance.
+
+        Raises:
+            ValueError if no internal basis is set
+
+        """
+        if self._internal_basis is None:
+            raise ValueError("Rigid-body contamination requires an internal basis.")
+        hessian = self._get_mass_weighted_hessian()
+        rigid_basis = get_rigid_body_basis(self._atoms[self.get_mask()])
+        rigid = hessian @ rigid_basis.astype(hessian.dtype, copy=False)
+        return np.linalg.norm(rigid) / np.linalg.norm(hessian)
+
+    def refine_frequencies(self, mode_indices: Sequence[int] = None,
+                           hessian=None) -> np.ndarray:
+        """Refine the frequencies of a (single precision) analysis in double
+        precision
+
+        The eigenvalue of each mode is replaced by its Rayleigh quotient with
+        the float64 mass-weighted Hessian, which is accurate to second order
+        in the error of the mode. The residual norm r of the mode bounds the
+        distance of the Rayleigh quotient to an exact eigenvalue, which is
+        reported as a bound on the frequency error.
+
+        Args:
+            mode_indices: Modes to refine, e.g. only the ambiguously matched
+                ones. Default is all modes.
+
+            hessian: The Hessian as given on creation, before it was rounded
+                to single precision, in the same layout (2D, sparse or packed
+                triangle). Default is the stored Hessian, which is exact only
+                if it was given in single precision.
+
+        Returns:
+            Frequency error bound in cm-1 of each refined mode
+
+        """
+        energies, modes = self.get_energies_and_modes()
+        if mode_indices is None:
+            mode_indices = np.arange(len(energies))
+        mode_indices = np.asarray(mode_indices, dtype=int)
+
+        mass_weights = self._get_mass_weights().astype(np.float64)
+        vectors = modes[mode_indices].reshape(len(mode_indices), -1).T.astype(np.float64)
+        vectors /= mass_weights[:, np.newaxis]
+        vectors /= np.linalg.norm(vectors, axis=0)
+
+        scaling = self._get_hessian_scaling().astype(np.float64)
+        if hessian is None:
+            hessian = (self._sparse_hessian if self._sparse_hessian is not None
+                       else self._get_raw_hessian_2d())
+        elif self._packed_hessian is not None:
+            hessian = triangle_to_2d(np.asarray(hessian, dtype=np.float64),
+                                     lower=self._packed_lower)
+        if issparse(hessian):
+            hessian = csr_matrix(hessian, dtype=np.float64)
+        else:
+            hessian = np.asarray(hessian, dtype=np.float64).reshape(len(scaling), len(scaling))
+        hessian_vectors = hessian @ (vectors * scaling[:, np.newaxis])
+        hessian_vectors *= scaling[:, np.newaxis]
+
+        omega2 = (vectors * hessian_vectors).sum(axis=0)
+        residuals = np.linalg.norm(hessian_vectors - vectors * omega2, axis=0)
+
+        freq_conversion = ENERGY_CONVERSION / units.invcm
+        error_bound = freq_conversion * (np.abs(omega2)**0.5
+                                         - np.maximum(np.abs(omega2) - residuals, 0)**0.5)
+
+        cached_energies = self._energies_and_modes_cache[0]
+        cached_energies[mode_indices] = ENERGY_CONVERSION * omega2.astype(complex)**0.5
+        self._frequency_error_bound = np.full(len(energies), np.nan)
+        self._frequency_error_bound[mode_indices] = error_bound
+        return error_bound
+
+    def get_frequency_error_bound(self) -> np.ndarray:
+        """Frequency error bound in cm-1 of each mode after
+        refine_frequencies(), NaN for the modes that were not refined, or
+        None if the frequencies were not refined"""
+        if self._frequency_error_bound is None:
+            return None
+        return self._frequency_error_bound.copy()
+
+    def set_energies_and_modes(self, energies: np.ndarray, modes: np.ndarray,
+                               frequency_error_bound: np.ndarray = None) -> None:
+        """Use previously computed energies and modes (as returned by
+        get_energies_and_modes() with all_atoms=False) instead of
+        diagonalizing the Hessian, and their frequency error bound if they
+        were refined, see get_frequency_error_bound()"""
+        self._energies_and_modes_cache = (np.asarray(energies), np.asarray(modes))
+        if frequency_error_bound is not None:
+            self._frequency_error_bound = np.asarray(frequency_error_bound)
+
+    def _get_fragments(self) -> List[np.ndarray]:
+        """Hessian indices of each fragment, see find_fragments()"""
+        if self._fragment_dofs is None:
+            self._fragment_dofs = find_fragments(self._get_raw_hessian_2d())
+        return self._fragment_dofs
+
+    def _get_mass_weights(self) -> np.ndarray:
+        if self._context is not None:
+            return self._context.get_mass_weights(np.flatnonzero(self.get_mask()), self._dtype)
+
+        masses = self._atoms[self.get_mask()].get_masses()
+        if not np.all(masses):
+            raise ValueError('Zero mass encountered in one or more of '
+                             'the vibrated atoms. Use Atoms.set_masses()'
+                             ' to set all masses to non-zero values.')
+        return np.repeat(masses**-0.5, 3).astype(self._dtype)
+
+    def _get_hessian_scaling(self) -> np.ndarray:
+        """Mass-weighting vector with the unit conversion folded in, so that
+        scaling * H * scaling is the mass-weighted Hessian in eV A-2 amu-1"""
+        if self._context is not None:
+            return self._context.get_scaling(np.flatnonzero(self.get_mask()), self._unit_factor,
+                                             self._dtype)
+        return (self._unit_factor**0.5 * self._get_mass_weights()).astype(self._dtype)
+
+    def _get_raw_hessian_2d(self) -> np.ndarray:
+        """The Hessian in its input units as a (3N, 3N) array, not a copy
+        for 2D input"""
+        if self._sparse_hessian is not None:
+            return self._sparse_hessian.toarray()
+        elif self._packed_hessian is not None:
+            return triangle_to_2d(self._packed_hessian, lower=self._packed_lower,
+                                  triangle_indices=self._get_triangle_indices())
+        return self._hessian2d
+
+    def _get_triangle_indices(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._context is None:
+            return None
+        n = 3 * len(self._indices)
+        return self._context.get_triangle_indices(n, lower=self._packed_lower)
+
+    def _get_mass_weighted_hessian(self) -> np.ndarray:
+        """The mass-weighted Hessian, in the workspace of the context if there
+        is one, so it is only valid until the next analysis"""
+        scaling = self._get_hessian_scaling()
+        if self._context is None:
+            return scaling * self._get_raw_hessian_2d() * scaling[:, np.newaxis]
+
+        hessian = self._context.get_workspace(len(scaling), self._dtype)
+        np.multiply(self._get_raw_hessian_2d(), scaling[:, np.newaxis], out=hessian)
+        hessian *= scaling[np.newaxis, :]
+        return hessian
+
+    def _diagonalize(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Eigenvalues and (column) eigenvectors of the mass-weighted Hessian"""
+        if self._n_modes is not None:
+            return self._diagonalize_partial()
+        elif (self._packed_hessian is not None and self._internal_basis is None
+              and not self._fragments):
+            return self._diagonalize_packed()
+
+        hessian = self._get_mass_weighted_hessian()
+        if self._internal_basis is None and self._fragments:
+            if self._fragment_dofs is None:
+                self._fragment_dofs = find_fragments(hessian)
+            return _diagonalize_fragments(hessian, self._fragment_dofs)
+        elif self._internal_basis is None:
+            return eigh(hessian, overwrite_a=True, check_finite=False)
+
+        basis = self._internal_basis.astype(self._dtype, copy=False)
+        omega2, vectors = np.linalg.eigh(basis.T @ hessian @ basis)
+        return omega2, basis @ vectors
+
+    def _diagonalize_packed(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Diagonalize a packed Hessian with LAPACK, expanding it only once
+        into the buffer that the eigensolver overwrites
+
+        SciPy does not wrap the packed eigensolvers (spevd/spevx), so the
+        triangle is unpacked with tpttr into a Fortran-ordered array that is
+        mass-weighted in place and passed on to eigh without a copy.
+        """
+        scaling = self._get_hessian_scaling()
+
+        if self._context is not None:
+            # Only the stored triangle of the workspace is filled and referenced
+            hessian = self._context.get_workspace(len(scaling), self._dtype)
+            hessian[self._get_triangle_indices()] = self._packed_hessian
+            lower = self._packed_lower
+        else:
+            tpttr, = get_lapack_funcs(('tpttr',), (self._packed_hessian,))
+            # The row-major lower (upper) triangle is the column-major upper (lower) one
+            uplo = 'U' if self._packed_lower else 'L'
+            hessian, info = tpttr(len(scaling), self._packed_hessian, uplo=uplo)
+            if info != 0:
+                raise ValueError("Unpacking the Hessian failed with LAPACK info {}".format(info))
+            lower = uplo == 'L'
+
+        hessian *= scaling[:, np.newaxis]
+        hessian *= scaling[np.newaxis, :]
+        return eigh(hessian, lower=lower, overwrite_a=True, check_finite=False)
+
+    def _diagonalize_partial(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The n_modes eigenpairs closest to the target frequency, by eigsh
+        in shift-invert mode"""
+        if self._sparse_hessian is None:
+            hessian = self._get_mass_weighted_hessian()
+        else:
+            scaling = diags(self._get_hessian_scaling())
+            hessian = (scaling @ self._sparse_hessian @ scaling).tocsc()
+
+        sigma = (self._target_freq * units.invcm / ENERGY_CONVERSION)**2
+        omega2, vectors = eigsh(hessian, k=self._n_modes, sigma=sigma, which='LM')
+
+        order = np.argsort(omega2)
+        return omega2[order], vectors[:, order]
+
+    def _calc_energies_and_modes(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self._to_energies_and_modes(*self._diagonalize())
+
+    def _to_energies_and_modes(self, omega2: np.ndarray, vectors: np.ndarray
+                               ) -> Tuple[np.ndarray, np.ndarray]:
+        """Energies and Cartesian modes from the eigenvalues and (column)
+        eigenvectors of the mass-weighted Hessian"""
+        mass_weights = self._get_mass_weights()
+        energies = ENERGY_CONVERSION * omega2.astype(complex)**0.5
+
+        # The eigenvectors are owned by the caller, scale them in place
+        vectors *= mass_weights[:, np.newaxis]
+        modes = vectors.T.reshape(len(omega2), len(mass_weights) // 3, 3)
+
+        return energies, modes
 
     @staticmethod
     def _check_dimensions(atoms: Atoms,
@@ -116,9 +635,190 @@ class VibrationsData(VibrationsData):
             ref_shape = [n_atoms, 3, n_atoms, 3]
             ref_shape_txt = '{n:d}x3x{n:d}x3'.format(n=n_atoms)
 
-        if (isinstance(hessian, np.ndarray)
+        if ((isinstance(hessian, np.ndarray) or issparse(hessian))
             and hessian.shape == tuple(ref_shape)):
             return n_atoms
         else:
             raise ValueError("Hessian for these atoms should be a "
                              "{} numpy array.".format(ref_shape_txt))
+
+
+def get_rigid_body_basis(atoms: Atoms, tol: float = 1e-6) -> np.ndarray:
+    """Orthonormal basis of the mass-weighted translations and rotations
+
+    Args:
+        atoms: Geometry and masses of the system
+        tol: Relative singular value below which a rigid-body direction is
+            considered redundant, e.g. the rotation around the axis of a
+            linear molecule
+
+    Returns:
+        (3N, n_rigid) array, with n_rigid 6 for non-linear and 5 for linear
+        molecules
+
+    """
+    masses = atoms.get_masses()
+    sqrt_masses = np.sqrt(masses)[:, np.newaxis]
+    positions = atoms.get_positions() - atoms.get_center_of_mass()
+
+    directions = []
+    for axis in np.eye(3):
+        directions.append(sqrt_masses * axis[np.newaxis])
+    for axis in np.eye(3):
+        directions.append(sqrt_masses * np.cross(axis, positions))
+    directions = np.array(directions).reshape(6, -1).T
+
+    u, s, _ = np.linalg.svd(directions, full_matrices=False)
+    return u[:, s > tol * s[0]]
+
+
+def _get_rigid_count(n_atoms: int) -> int:
+    """Number of rigid-body modes of n_atoms atoms without a geometry,
+    assuming a non-linear molecule from three atoms on"""
+    if n_atoms == 1:
+        return 3
+    if n_atoms == 2:
+        return 5
+    return 6
+
+
+def get_internal_basis(atoms: Atoms, tol: float = 1e-6) -> np.ndarray:
+    """Orthonormal basis of the mass-weighted internal space, orthogonal to
+    the translations and rotations (Eckart conditions) of get_rigid_body_basis()
+
+    Returns:
+        (3N, 3N-6) array, (3N, 3N-5) for linear molecules
+
+    """
+    rigid_basis = get_rigid_body_basis(atoms, tol)
+    u = np.linalg.svd(rigid_basis, full_matrices=True)[0]
+    return u[:, rigid_basis.shape[1]:]
+
+
+def find_fragments(hessian_2d: np.ndarray, tol: float = 0.) -> List[np.ndarray]:
+    """Groups of atoms that do not couple to each other in the Hessian
+
+    The fragments are the connected components of the graph of atoms that
+    have a Hessian block with an element larger than tol in magnitude.
+
+    Returns:
+        List of the Hessian (3N) indices of each fragment
+
+    """
+    n_atoms = len(hessian_2d) // 3
+    blocks = np.abs(hessian_2d).reshape(n_atoms, 3, n_atoms, 3).max(axis=(1, 3))
+    n_fragments, labels = connected_components(csr_matrix(blocks > tol), directed=False)
+
+    dof_labels = np.repeat(labels, 3)
+    return [np.flatnonzero(dof_labels == label) for label in range(n_fragments)]
+
+
+def _diagonalize_fragments(hessian_2d: np.ndarray, fragments: List[np.ndarray]
+                           ) -> Tuple[np.ndarray, np.ndarray]:
+    """Eigenvalues and eigenvectors of a block-diagonal matrix from the
+    independent (threaded) diagonalization of each block"""
+    if len(fragments) == 1:
+        return np.linalg.eigh(hessian_2d)
+
+    with ThreadPoolExecutor() as pool:
+        results = list(pool.map(lambda dofs: np.linalg.eigh(hessian_2d[np.ix_(dofs, dofs)]),
+                                fragments))
+
+    eigenvalues = np.empty(len(hessian_2d))
+    vectors = np.zeros_like(hessian_2d)
+    start = 0
+    for dofs, (block_eigenvalues, block_vectors) in zip(fragments, results):
+        end = start + len(dofs)
+        eigenvalues[start:end] = block_eigenvalues
+        vectors[dofs, start:end] = block_vectors
+        start = end
+
+    order = np.argsort(eigenvalues, kind='stable')
+    return eigenvalues[order], vectors[:, order]
+
+
+def triangle_to_2d(hessian_triangle: np.ndarray, lower: bool = True,
+                   triangle_indices: Tuple[np.ndarray, np.ndarray] = None) -> np.ndarray:
+    """Expand the row-major lower or upper triangle of a symmetric matrix,
+    given in ((3N)**2+3N)/2 format, to the full (3N, 3N) matrix, optionally
+    with precomputed np.tril_indices/np.triu_indices"""
+    n = int(round((sqrt(8 * len(hessian_triangle) + 1) - 1) / 2))
+    if triangle_indices is None:
+        triangle_indices = np.tril_indices(n) if lower else np.triu_indices(n)
+    rows, cols = triangle_indices
+
+    hessian_2d = np.empty((n, n), dtype=hessian_triangle.dtype)
+    hessian_2d[rows, cols] = hessian_triangle
+    hessian_2d[cols, rows] = hessian_triangle
+    return hessian_2d
+
+
+def convert_format(hessian, from_format: str, to_format: str):
+    """Convert a Hessian between the formats '2d', 'upper', 'lower' (the
+    row-major triangle in ((3N)**2+3N)/2 format) and 'sparse'
+
+    Sparse Hessians converted to '2d' stay sparse, which the analysis
+    accepts for '2d'.
+
+    Raises:
+        ValueError for other formats
+
+    """
+    for hes_format in (from_format, to_format):
+        if hes_format not in ('2d', 'upper', 'lower', 'sparse'):
+            raise ValueError("Unknown Hessian format: {}".format(hes_format))
+    if from_format == to_format:
+        return hessian
+
+    if from_format in ('upper', 'lower'):
+        hessian = triangle_to_2d(np.asarray(hessian), lower=from_format == 'lower')
+    if to_format == 'sparse':
+        return coo_matrix(hessian)
+    elif to_format == '2d':
+        return hessian
+
+    if issparse(hessian):
+        hessian = hessian.toarray()
+    n = len(hessian)
+    return hessian[np.tril_indices(n) if to_format == 'lower' else np.triu_indices(n)]
+
+
+def get_partial_hessian(hessian_2d: np.ndarray, indices: Sequence[int],
+                        method: str = 'extract') -> np.ndarray:
+    """Hessian of a subset of atoms
+
+    Args:
+        hessian_2d: Full (3N, 3N) Hessian, dense or scipy.sparse
+        indices: Indices of the atoms to keep
+        method: 'extract' takes the block of the subset, i.e. the rest of the
+            system is frozen (partial Hessian vibrational analysis).
+            'schur' takes the Schur complement of the rest of the system,
+            H_aa - H_ab H_bb^-1 H_ba, i.e. the rest of the system relaxes
+            with the subset and the rigid-body modes are kept.
+
+    Returns:
+        (3n, 3n) Hessian of the n atoms in indices
+
+    """
+    dofs = (3 * np.asarray(indices)[:, np.newaxis] + np.arange(3)).ravel()
+    sparse = issparse(hessian_2d)
+    if sparse:
+        hessian_2d = csr_matrix(hessian_2d)
+
+    def block(rows, cols):
+        if sparse:
+            return hessian_2d[rows][:, cols]
+        return hessian_2d[np.ix_(rows, cols)]
+
+    active = block(dofs, dofs)
+
+    if method == 'extract':
+        return active
+    elif method == 'schur':
+        rest = np.setdiff1d(np.arange(hessian_2d.shape[0]), dofs)
+        coupling = block(rest, dofs)
+        if sparse:
+            return active - coupling.T @ spsolve(block(rest, rest).tocsc(), coupling.tocsc())
+        return active - coupling.T @ np.linalg.solve(block(rest, rest), coupling)
+    else:
+        raise ValueError("Unknown partial Hessian method: {}".format(method))
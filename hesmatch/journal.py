@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import numpy as np
+from scipy.sparse import issparse
+
+
+# Number of elements converted at a time while hashing
+HASH_CHUNK_SIZE = 2**20
+
+
+def hash_hessian(hessian, unit_factor=1.):
+    """
+    SHA-256 hex digest of the content of a dense or sparse Hessian after multiplying it
+    with unit_factor, including its shape and data type. The conversion is done in chunks
+    of HASH_CHUNK_SIZE elements. Sparse Hessians are hashed in canonical CSR form, so that
+    the order of their entries does not matter.
+    """
+    digest = hashlib.sha256()
+    if issparse(hessian):
+        hessian = hessian.tocsr(copy=True)
+        hessian.sum_duplicates()
+        hessian.sort_indices()
+        # Adding zero turns -0.0 into 0.0
+        hessian.data = hessian.data * unit_factor + 0.
+        blocks = [hessian.data, hessian.indices.astype(np.int64),
+                  hessian.indptr.astype(np.int64)]
+        dtype = hessian.dtype
+    else:
+        hessian = np.asarray(hessian)
+        rows = max(HASH_CHUNK_SIZE // max(hessian[:1].size, 1), 1)
+        blocks = (np.ascontiguousarray(hessian[start:start + rows] * unit_factor + 0.)
+                  for start in range(0, len(hessian), rows))
+        dtype = (hessian[:0] * unit_factor).dtype
+
+    digest.update(repr((hessian.shape, dtype.str, issparse(hessian))).encode())
+    for block in blocks:
+        digest.update(block.data)
+    return digest.hexdigest()
+
+
+class Journal:
+    """
+    Append-only record of the matching results of a batch run, one JSON line per match
+    keyed by the hash of the match Hessian, so that an interrupted run can be resumed
+    without redoing the completed matches. Identical match Hessians at further positions
+    of the input get a line with only the key and the position.
+
+    The first line holds a header identifying the reference Hessian and the settings. A
+    journal is only resumed with the same header. Every entry is flushed to disk as soon
+    as it is written, and a truncated last line of a crashed run is ignored.
+
+    Parameters
+    ----------
+    path : str
+    header : dict
+        JSON serializable identification of the reference and the settings.
+
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.results = {}
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            stored_header, self.results = read_journal(path)
+            if stored_header != header:
+                raise ValueError(f"The journal {path} belongs to a different reference "
+                                 "Hessian or different settings.")
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                complete = f.read() == b'\n'
+            self._file = open(path, 'a')
+            if not complete:
+                self._file.write('\n')
+        else:
+            self._file = open(path, 'w')
+            self._write(header)
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def is_recorded(self, key, index):
+        """
+        Whether the match Hessian at position index of the input is recorded under key.
+        """
+        return key in self.results and index in self.results[key]['indices']
+
+    def get_result(self, key):
+        """
+        Chosen overlaps, frequency differences and error recorded under key.
+        """
+        entry = self.results[key]
+        return tuple(np.array(entry[name]) for name in ('chosen_overlaps', 'diff', 'error'))
+
+    def record(self, key, result, index=None):
+        """
+        Append the chosen overlaps, frequency differences and error of a match, with the
+        position of the match Hessian in the input, or only the position if the result
+        is already recorded under key. Recording a position twice does nothing.
+        """
+        if key in self.results:
+            if index not in self.results[key]['indices']:
+                self.results[key]['indices'].append(index)
+                self._write({'key': key, 'index': index})
+            return
+
+        chosen_overlaps, diff, error = result
+        entry = {'key': key, 'index': index,
+                 'chosen_overlaps': np.asarray(chosen_overlaps).tolist(),
+                 'diff': np.asarray(diff).tolist(), 'error': np.asarray(error).tolist()}
+        self._write(entry)
+        self.results[key] = _to_result(entry)
+
+    def close(self):
+        self._file.close()
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+def read_journal(path):
+    """
+    Header and results (dictionary of entries by key) of a journal, with the positions of
+    all identical match Hessians in the list 'indices' of an entry. Lines that cannot be
+    parsed, i.e. the last line of an interrupted run, are skipped.
+    """
+    header = None
+    results = {}
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if header is None:
+                header = entry
+            elif entry['key'] in results:
+                results[entry['key']]['indices'].append(entry['index'])
+            elif 'diff' in entry:
+                results[entry['key']] = _to_result(entry)
+    return header, results
+
+
+def _to_result(entry):
+    result = dict(entry, indices=[entry['index']])
+    del result['index']
+    return result
+
+
+def consolidate_journals(paths, output=None):
+    """
+    Merge the results of one or more journals with the same header, e.g. of a resumed run
+    or of a batch split over several jobs, into one row per position in the input,
+    including identical match Hessians, in the order of the input. Positions that are
+    recorded more than once are kept once, rows without a position (-1) come last in
+    the order in which they were recorded.
+
+    Parameters
+    ----------
+    paths : list of str
+    output : str, optional
+        .npz file to save the merged keys, indices, chosen_overlaps, diff and error to.
+
+    Returns
+    -------
+    results : list of dict
+        Entries of read_journal with the position in 'index' instead of 'indices'.
+
+    """
+    header = None
+    merged = {}
+    for path in paths:
+        journal_header, results = read_journal(path)
+        if header is not None and journal_header != header:
+            raise ValueError(f"The journal {path} belongs to a different reference Hessian "
+                             "or different settings.")
+        header = journal_header
+        for key, entry in results.items():
+            indices = merged.setdefault(key, dict(entry, indices=[]))['indices']
+            for index in entry['indices']:
+                if index is None or index not in indices:
+                    indices.append(index)
+
+    results = []
+    for entry in merged.values():
+        row = {name: value for name, value in entry.items() if name != 'indices'}
+        results.extend(dict(row, index=index) for index in entry['indices'])
+    results.sort(key=lambda entry: (entry['index'] is None, entry['index'] or 0))
+    if output is not None:
+        np.savez(output, keys=np.array([entry['key'] for entry in results]),
+                 indices=np.array([-1 if entry['index'] is None else entry['index']
+                                   for entry in results]),
+                 chosen_overlaps=np.array([entry['chosen_overlaps'] for entry in results]),
+                 diff=np.array([entry['diff'] for entry in results]),
+                 error=np.array([entry['error'] for entry in results]))
+    return results
@@ -1,5 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from pulp import LpVariable, LpProblem, LpMaximize, lpSum
+from scipy.optimize import linear_sum_assignment
+from pulp import LpVariable, LpProblem, LpMaximize, lpSum, PULP_CBC_CMD
 
 
 def calc_freq_diff(ref_freqs, match_freqs):
@@ -31,17 +33,8 @@ def do_matching(overlap_matrix, ref_freqs, match_freqs, match_modes, weight=100)
 
     """
     chosen_overlaps, unordered_ref_freqs, unordered_match_freqs = [], [], []
-    n_freqs = len(overlap_matrix)
-
-    choices = LpVariable.dicts("choice", (range(n_freqs), range(n_freqs)), cat="Binary")
-    prob = LpProblem("freq macher", LpMaximize)
-
-    for i in range(n_freqs):
-        prob += lpSum([choices[j][i] for j in range(n_freqs)]) == 1
-        prob += lpSum([choices[i][j] for j in range(n_freqs)]) == 1
-
-    prob += lpSum([choices[i][j]*(overlap_matrix[j][i]-abs(ref_freqs[i] - match_freqs[j])/weight)
-                   for j in range(n_freqs) for i in range(n_freqs)])
+    prob, choices = _build_matching_problem(len(overlap_matrix))
+    prob += _matching_objective(choices, overlap_matrix, ref_freqs, match_freqs, weight)
     prob.solve()
 
     for var in prob.variables():
@@ -59,6 +52,288 @@ def do_matching(overlap_matrix, ref_freqs, match_freqs, match_modes, weight=100)
     return chosen_overlaps, match_freqs, match_modes
 
 
+def calc_cost_matrix(overlap_matrix, ref_freqs, match_freqs, weight=100):
+    """
+    Cost of assigning each reference mode to each match mode, i.e. the negative of
+    the objective maximized in do_matching:
+        Cost_ij = -( ModeRef_i * ModeMatch_j - |FreqRef_i - FreqMatch_j| / weight )
+
+    Leading batch dimensions are broadcast, so a stack of overlap matrices and
+    frequencies gives a stack of cost matrices.
+
+    Parameters
+    ----------
+    overlap_matrix : (..., n_mode, n_mode) Numpy array
+        Indexed as [match, ref], as returned by calc_overlap_matrix.
+    ref_freqs : (..., n_mode) Numpy array
+    match_freqs : (..., n_mode) Numpy array
+    weight : float, optional
+
+    Returns
+    -------
+    cost_matrix : (..., n_mode, n_mode) Numpy array
+        Indexed as [ref, match].
+
+    """
+    ref_freqs = np.asarray(ref_freqs)
+    match_freqs = np.asarray(match_freqs)
+    freq_diff = np.abs(ref_freqs[..., :, np.newaxis] - match_freqs[..., np.newaxis, :])
+    return freq_diff / weight - np.swapaxes(overlap_matrix, -1, -2)
+
+
+def solve_assignments(cost_matrices, n_jobs=None):
+    """
+    Solve a stack of same-size linear assignment problems in one call.
+
+    Problems in which every row has a distinct cheapest column are solved by that
+    choice directly, which is checked for the whole stack at once. The remaining
+    problems are handed to scipy's linear_sum_assignment on a thread pool.
+
+    Parameters
+    ----------
+    cost_matrices : (n_batch, n, n) Numpy array
+    n_jobs : int, optional
+        Number of threads for the problems that need a full solve. The default is
+        None, which lets the pool pick based on the number of CPUs.
+
+    Returns
+    -------
+    permutations : (n_batch, n) Numpy array
+        permutations[b, i] is the column assigned to row i in problem b.
+
+    """
+    cost_matrices = np.asarray(cost_matrices)
+    if cost_matrices.ndim != 3 or cost_matrices.shape[1] != cost_matrices.shape[2]:
+        raise ValueError("Cost matrices should be given as a (B, n, n) numpy array.")
+
+    n_batch, n = cost_matrices.shape[:2]
+    permutations = np.argmin(cost_matrices, axis=2)
+
+    # The row-wise minimum is optimal whenever it is already a permutation
+    counts = np.zeros((n_batch, n), dtype=int)
+    np.add.at(counts, (np.arange(n_batch)[:, np.newaxis], permutations), 1)
+    unsolved = np.flatnonzero((counts != 1).any(axis=1))
+
+    def solve(b):
+        return linear_sum_assignment(cost_matrices[b])[1]
+
+    if len(unsolved) == 1 or n_jobs == 1:
+        for b in unsolved:
+            permutations[b] = solve(b)
+    elif len(unsolved) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            for b, perm in zip(unsolved, pool.map(solve, unsolved)):
+                permutations[b] = perm
+
+    return permutations
+
+
+def cluster_degenerate_modes(freqs, tol):
+    """
+    Group sorted frequencies into clusters of near-degenerate modes, where consecutive
+    frequencies closer than tol belong to the same cluster.
+
+    Returns
+    -------
+    clusters : list of Numpy arrays
+        Mode indices of each cluster.
+
+    """
+    breaks = np.flatnonzero(np.diff(freqs) >= tol) + 1
+    return np.split(np.arange(len(freqs)), breaks)
+
+
+def calc_subspace_overlap(ref_modes, match_modes):
+    """
+    Overlap of the subspaces spanned by two sets of modes as the mean cosine of their
+    principal angles, obtained from the SVD of the overlap of orthonormal bases.
+    For single modes this is the absolute overlap of calc_overlap_matrix.
+    """
+    ref_basis = np.linalg.qr(ref_modes.reshape(len(ref_modes), -1).T)[0]
+    match_basis = np.linalg.qr(match_modes.reshape(len(match_modes), -1).T)[0]
+    return np.linalg.svd(ref_basis.T @ match_basis, compute_uv=False).mean()
+
+
+def do_subspace_matching(ref_freqs, ref_modes, match_freqs, match_modes, tol=1., weight=100):
+    """
+    Match to the reference vibrational modes/frequencies like do_matching, but with
+    near-degenerate modes clustered in both spectra. Clusters of equal size are matched
+    by the principal angles between their subspaces, which does not depend on the
+    arbitrary rotation of the modes inside a degenerate subspace.
+
+    Each matched match cluster is then rotated onto its reference cluster (orthogonal
+    Procrustes) and expanded back to modes. Cluster sizes that occur a different
+    number of times in the two spectra are matched mode by mode.
+
+    Parameters
+    ----------
+    ref_freqs : (n_mode) Numpy array
+    ref_modes : (n_mode, n_atom, 3) Numpy array
+    match_freqs : (n_mode) Numpy array
+    match_modes : (n_mode, n_atom, 3) Numpy array
+    tol : float, optional
+        Largest frequency gap within a cluster of near-degenerate modes.
+    weight : float, optional
+
+    Returns
+    -------
+    chosen_overlaps : (n_mode) Numpy array
+    match_freqs : (n_mode) Numpy array
+    match_modes : (n_mode, n_atom, 3) Numpy array
+
+    """
+    ref_clusters = cluster_degenerate_modes(ref_freqs, tol)
+    match_clusters = cluster_degenerate_modes(match_freqs, tol)
+
+    # Only equally sized clusters can be paired, split the sizes that do not balance
+    ref_sizes = np.array([len(cluster) for cluster in ref_clusters])
+    match_sizes = np.array([len(cluster) for cluster in match_clusters])
+    for size in set(ref_sizes) | set(match_sizes):
+        if size > 1 and (ref_sizes == size).sum() != (match_sizes == size).sum():
+            ref_clusters = _split_clusters(ref_clusters, size)
+            match_clusters = _split_clusters(match_clusters, size)
+
+    chosen_overlaps = np.empty(len(ref_freqs))
+    matched_freqs = np.empty(len(ref_freqs))
+    matched_modes = np.empty_like(match_modes)
+
+    for size in set(len(cluster) for cluster in ref_clusters):
+        ref_group = [cluster for cluster in ref_clusters if len(cluster) == size]
+        match_group = [cluster for cluster in match_clusters if len(cluster) == size]
+
+        overlaps = np.array([[calc_subspace_overlap(ref_modes[ref], match_modes[match])
+                              for match in match_group] for ref in ref_group])
+        ref_means = np.array([ref_freqs[ref].mean() for ref in ref_group])
+        match_means = np.array([match_freqs[match].mean() for match in match_group])
+        cost = calc_cost_matrix(overlaps.T, ref_means, match_means, weight)
+
+        for a, b in zip(*linear_sum_assignment(cost)):
+            ref, match = ref_group[a], match_group[b]
+            rotation = _procrustes_rotation(match_modes[match], ref_modes[ref])
+            rotated = np.einsum('ij,jkl->ikl', rotation, match_modes[match])
+
+            matched_modes[ref] = rotated
+            matched_freqs[ref] = rotation**2 @ match_freqs[match]
+            chosen_overlaps[ref] = np.abs((normalize_modes(rotated) * ref_modes[ref]).sum(axis=(1, 2)))
+
+    return chosen_overlaps, matched_freqs, matched_modes
+
+
+def _split_clusters(clusters, size):
+    split = []
+    for cluster in clusters:
+        if len(cluster) == size:
+            split.extend(np.split(cluster, size))
+        else:
+            split.append(cluster)
+    return split
+
+
+def _procrustes_rotation(modes, target_modes):
+    """
+    Orthogonal matrix that best rotates a set of modes onto a set of target modes.
+    """
+    u, _, vt = np.linalg.svd(target_modes.reshape(len(target_modes), -1)
+                             @ modes.reshape(len(modes), -1).T)
+    return u @ vt
+
+
+def sweep_weights(overlap_matrix, ref_freqs, match_freqs, weights):
+    """
+    Solve the matching of do_matching for a list of weights, reusing the overlap
+    matrix and a single assignment problem. Each solve is warm-started from the
+    assignment found for the previous weight.
+
+    Parameters
+    ----------
+    overlap_matrix : (n_mode, n_mode) Numpy array
+    ref_freqs : (n_mode) Numpy array
+    match_freqs : (n_mode) Numpy array
+    weights : sequence of float
+
+    Returns
+    -------
+    assignments : (n_weight, n_mode) Numpy array
+        assignments[k, i] is the match mode assigned to reference mode i for weights[k].
+    changes : list of float
+        Weights at which the assignment differs from the one for the previous weight.
+
+    """
+    n_freqs = len(overlap_matrix)
+    prob, choices = _build_matching_problem(n_freqs)
+    solver = PULP_CBC_CMD(msg=False, warmStart=True)
+
+    assignments, changes = [], []
+    for weight in weights:
+        prob.setObjective(_matching_objective(choices, overlap_matrix, ref_freqs, match_freqs,
+                                              weight))
+        if assignments:
+            for i in range(n_freqs):
+                for j in range(n_freqs):
+                    choices[i][j].setInitialValue(int(assignments[-1][i] == j))
+        prob.solve(solver)
+
+        assignment = _read_assignment(prob, n_freqs)
+        if assignments and not np.array_equal(assignment, assignments[-1]):
+            changes.append(weight)
+        assignments.append(assignment)
+
+    return np.array(assignments), changes
+
+
+def weight_sweep(ref, match, weights):
+    """
+    Sweep the matching weight between a reference and a match vibrational analysis.
+    The frequencies, modes and overlap matrix are computed once for all weights.
+    """
+    ref_freqs, ref_modes = _get_vibrations(ref)
+    match_freqs, match_modes = _get_vibrations(match)
+    overlap_matrix = calc_overlap_matrix(ref_modes, match_modes)
+    return sweep_weights(overlap_matrix, ref_freqs, match_freqs, weights)
+
+
+def _build_matching_problem(n_freqs):
+    """
+    Binary assignment problem between reference and match modes, without objective.
+    """
+    choices = LpVariable.dicts("choice", (range(n_freqs), range(n_freqs)), cat="Binary")
+    prob = LpProblem("freq macher", LpMaximize)
+
+    for i in range(n_freqs):
+        prob += lpSum([choices[j][i] for j in range(n_freqs)]) == 1
+        prob += lpSum([choices[i][j] for j in range(n_freqs)]) == 1
+
+    return prob, choices
+
+
+def _matching_objective(choices, overlap_matrix, ref_freqs, match_freqs, weight):
+    n_freqs = len(overlap_matrix)
+    return lpSum([choices[i][j]*(overlap_matrix[j][i]-abs(ref_freqs[i] - match_freqs[j])/weight)
+                  for j in range(n_freqs) for i in range(n_freqs)])
+
+
+def _read_assignment(prob, n_freqs):
+    """
+    Match mode index chosen for each reference mode in a solved assignment problem.
+    """
+    assignment = np.empty(n_freqs, dtype=int)
+    for var in prob.variables():
+        if var.varValue is not None and round(var.varValue) == 1:
+            i, j = [int(n) for n in var.name.split('_')[1:]]
+            assignment[i] = j
+    return assignment
+
+
+def _get_vibrations(vib_data):
+    """
+    Frequencies and normalized modes of a vibrational analysis without the rigid-body modes.
+    """
+    n_rigid = vib_data.get_n_rigid()
+    freqs = vib_data.get_frequencies().real[n_rigid:]
+    modes = normalize_modes(vib_data.get_modes()[n_rigid:])
+    return freqs, modes
+
+
 def normalize_modes(modes):
     """
     Normalize the vibrational modes so that root mean square is equal to 1.
@@ -68,25 +343,45 @@ def normalize_modes(modes):
     return modes / normalization[:, np.newaxis, np.newaxis]
 
 
-def calc_overlap_matrix(ref_modes, match_modes):
+def calc_overlap_matrix(ref_modes, match_modes, precision=None):
     """
     Calculate all combination of overlaps between ref and match vibrational modes.
+    With precision 'single' or 'double' the product is done in float32 or float64,
+    by default in the precision of the modes.
     """
-    return np.abs((match_modes[:, np.newaxis] * ref_modes[np.newaxis]).sum(axis=2).sum(axis=2))
+    if precision is not None:
+        dtype = np.float32 if precision == 'single' else np.float64
+        ref_modes = ref_modes.astype(dtype, copy=False)
+        match_modes = match_modes.astype(dtype, copy=False)
+    return np.abs(match_modes.reshape(len(match_modes), -1) @ ref_modes.reshape(len(ref_modes), -1).T)
 
 
-def matcher(ref, matches):
+def matcher(ref, matches, degenerate_tol=None):
 
-    ref_freqs = ref.get_frequencies().real[6:]
-    ref_modes = normalize_modes(ref.get_modes()[6:])
+    ref_freqs, ref_modes = _get_vibrations(ref)
 
     for match in matches:
-        match_freqs = match.get_frequencies().real[6:]
-        match_modes = normalize_modes(match.get_modes()[6:])
-        overlap_matrix = calc_overlap_matrix(ref_modes, match_modes)
+        print(*match_to_reference(ref_freqs, ref_modes, match, degenerate_tol))
+
 
+def match_to_reference(ref_freqs, ref_modes, match, degenerate_tol=None):
+    """
+    Match the modes of a vibrational analysis to the reference frequencies and normalized
+    modes, and return the chosen overlaps, the frequency differences and the error.
+    """
+    match_freqs, match_modes = _get_vibrations(match)
+    if len(match_freqs) != len(ref_freqs):
+        raise ValueError(f"The match has {len(match_freqs)} vibrational modes but the "
+                         f"reference {len(ref_freqs)}, they need the same number of "
+                         "rigid-body modes, see hessian.VibrationsData.get_n_rigid.")
+
+    if degenerate_tol is None:
+        overlap_matrix = calc_overlap_matrix(ref_modes, match_modes)
         chosen_overlaps, match_freqs, match_modes = do_matching(overlap_matrix, ref_freqs,
                                                                 match_freqs, match_modes)
+    else:
+        chosen_overlaps, match_freqs, match_modes = do_subspace_matching(
+            ref_freqs, ref_modes, match_freqs, match_modes, degenerate_tol)
 
-        diff, error = calc_freq_diff(ref_freqs, match_freqs)
-        print(chosen_overlaps, diff, error)
+    diff, error = calc_freq_diff(ref_freqs, match_freqs)
+    return chosen_overlaps, diff, error
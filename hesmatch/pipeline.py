@@ -0,0 +1,71 @@
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()
+
+
+def prefetch(iterable, size=2):
+    """
+    Iterate over iterable in a background thread, keeping up to size items read ahead
+    in a bounded queue. Reading and parsing the next Hessian then overlaps with the
+    analysis of the current one. Exceptions of the reader are raised in the consumer.
+    """
+    items = queue.Queue(maxsize=max(size, 1))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as error:
+            put((_DONE, error))
+        else:
+            put((_DONE, None))
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def map_ordered(func, iterable, n_jobs=None, size=None):
+    """
+    Lazily apply func to the items of iterable in a pool of n_jobs threads and yield the
+    results in order. At most size items (default 2 * n_jobs) are taken from iterable
+    ahead of the consumer, which bounds the memory use. n_jobs defaults to the number of
+    CPUs.
+    """
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if size is None:
+        size = 2 * n_jobs
+
+    with ThreadPoolExecutor(n_jobs) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= size:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,142 @@
+"""
+Binary framing of Hessians and results in a byte stream (pipe, socket or file).
+
+Every frame consists of a fixed 20 byte little-endian header
+
+    magic (4 bytes, b'HESM'), version (uint8), 3 padding bytes,
+    metadata length (uint32), payload length (uint64)
+
+followed by the metadata, a UTF-8 encoded JSON object with at least the key 'type', and
+the payload. Frame types:
+
+    array   A Hessian. The metadata holds 'dtype' (numpy type string) and 'shape', and the
+            payload the C-ordered data. Sparse Hessians have 'sparse': true and the
+            payload holds (int64 row, int64 column, float64 value) records, as binary .coo
+            files. 'format' and 'unit' declare the layout and unit of the Hessian if they
+            differ from the ones of the reader, see iter_arrays and server.serve_stream.
+            Further keys (e.g. 'id') are passed on.
+    result  Matching result with 'chosen_overlaps', 'diff' and 'error', no payload.
+    error   Failed request with 'message', no payload.
+    end     End of a stream of arrays, no payload.
+    shutdown  Stop the server (see server.serve_socket), no payload.
+"""
+import json
+import struct
+import numpy as np
+from scipy.sparse import coo_matrix, issparse
+from .hesmatch import UNIT_FACTORS
+from .hessian import convert_format
+
+MAGIC = b'HESM'
+VERSION = 1
+HEADER = struct.Struct('<4sB3xIQ')
+COO_RECORD = np.dtype([('row', '<i8'), ('col', '<i8'), ('value', '<f8')])
+
+
+def write_frame(stream, metadata, payload=b''):
+    """
+    Write a frame with the metadata dictionary and the payload (bytes-like) to a binary
+    stream and flush it.
+    """
+    metadata = json.dumps(metadata).encode()
+    payload = memoryview(payload).cast('B')
+    stream.write(HEADER.pack(MAGIC, VERSION, len(metadata), payload.nbytes))
+    stream.write(metadata)
+    stream.write(payload)
+    stream.flush()
+
+
+def read_frame(stream):
+    """
+    Read the next frame of a binary stream. Returns the metadata dictionary and the
+    payload (bytes), or None at the end of the stream.
+    """
+    header = _read_exactly(stream, HEADER.size, allow_eof=True)
+    if header is None:
+        return None
+
+    magic, version, metadata_size, payload_size = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("Not a hesmatch frame.")
+    if version != VERSION:
+        raise ValueError(f"Unsupported frame version {version}.")
+
+    metadata = json.loads(_read_exactly(stream, metadata_size).decode())
+    return metadata, _read_exactly(stream, payload_size)
+
+
+def write_array(stream, hessian, **metadata):
+    """
+    Write a dense or sparse Hessian as an array frame, with additional metadata.
+    """
+    if issparse(hessian):
+        hessian = coo_matrix(hessian)
+        records = np.empty(hessian.nnz, dtype=COO_RECORD)
+        records['row'], records['col'], records['value'] = hessian.row, hessian.col, hessian.data
+        metadata.update(dtype=records.dtype.str, shape=list(hessian.shape), sparse=True)
+        write_frame(stream, dict(metadata, type='array'), records)
+    else:
+        hessian = np.ascontiguousarray(hessian)
+        metadata.update(dtype=hessian.dtype.str, shape=list(hessian.shape), sparse=False)
+        write_frame(stream, dict(metadata, type='array'), hessian)
+
+
+def decode_array(metadata, payload, dtype=None):
+    """
+    Hessian of an array frame, optionally converted to dtype. Dense Hessians are read-only
+    views of the payload unless converted.
+    """
+    if metadata.get('sparse'):
+        records = np.frombuffer(payload, dtype=COO_RECORD)
+        return coo_matrix((records['value'], (records['row'], records['col'])),
+                          shape=metadata['shape'], dtype=dtype)
+
+    hessian = np.frombuffer(payload, dtype=np.dtype(metadata['dtype']))
+    hessian = hessian.reshape(metadata['shape'])
+    return hessian if dtype is None else hessian.astype(dtype, copy=False)
+
+
+def write_result(stream, result, **metadata):
+    """
+    Write the chosen overlaps, frequency differences and error of a match as a result frame.
+    """
+    chosen_overlaps, diff, error = result
+    write_frame(stream, dict(metadata, type='result',
+                             chosen_overlaps=np.asarray(chosen_overlaps).tolist(),
+                             diff=np.asarray(diff).tolist(), error=np.asarray(error).tolist()))
+
+
+def iter_arrays(stream, dtype=None, hes_format=None, unit=None):
+    """
+    Yield the Hessians of the array frames of a binary stream until an end frame or the
+    end of the stream. Hessians whose 'format' or 'unit' differ from hes_format or unit
+    are converted to them.
+    """
+    while True:
+        frame = read_frame(stream)
+        if frame is None or frame[0]['type'] == 'end':
+            return
+        metadata, payload = frame
+        if metadata['type'] != 'array':
+            raise ValueError(f"Expected an array frame, got '{metadata['type']}'.")
+
+        hessian = decode_array(metadata, payload)
+        if hes_format is not None and metadata.get('format', hes_format) != hes_format:
+            hessian = convert_format(hessian, metadata['format'], hes_format)
+        if unit is not None and metadata.get('unit', unit) != unit:
+            hessian = hessian * (UNIT_FACTORS[metadata['unit']] / UNIT_FACTORS[unit])
+        yield hessian if dtype is None else hessian.astype(dtype, copy=False)
+
+
+def _read_exactly(stream, size, allow_eof=False):
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            if allow_eof and remaining == size:
+                return None
+            raise EOFError("Truncated hesmatch frame.")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
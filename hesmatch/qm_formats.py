@@ -0,0 +1,141 @@
+"""
+Readers of the Hessians written by quantum chemistry programs, all in Hartree Bohr-2
+(unit 3). Each reader takes a text stream (or any iterable of lines), reads it line by
+line and returns a HessianData with the masses, atomic numbers and positions found in
+the file.
+"""
+from collections import namedtuple
+from itertools import chain
+import numpy as np
+from ase.data import atomic_masses, atomic_numbers
+from ase.units import Bohr
+from .hesmatch import HARTREE_BOHR2
+
+HessianData = namedtuple('HessianData', ['hessian', 'hes_format', 'unit', 'masses', 'numbers',
+                                         'positions'])
+HessianData.__doc__ = """
+Hessian of a quantum chemistry output file in the given format ('2d' or 'lower') and unit,
+with the masses, atomic numbers and positions (A) of the atoms, or None if not in the file.
+"""
+
+
+def read_fchk(lines):
+    """
+    Gaussian formatted checkpoint file: the lower triangle of the 'Cartesian Force
+    Constants', the 'Real atomic weights', the 'Atomic numbers' and the 'Current cartesian
+    coordinates'.
+    """
+    sections = {'Cartesian Force Constants': None, 'Real atomic weights': None,
+                'Atomic numbers': None, 'Current cartesian coordinates': None}
+    lines = iter(lines)
+    for line in lines:
+        name = line[:40].strip()
+        if name not in sections or 'N=' not in line:
+            continue
+        data_type = line[43]
+        size = int(line.split('N=')[1])
+        sections[name] = _read_values(lines, size, int if data_type == 'I' else float)
+
+    if sections['Cartesian Force Constants'] is None:
+        raise ValueError("No Cartesian Force Constants in the fchk file.")
+
+    positions = sections['Current cartesian coordinates']
+    if positions is not None:
+        positions = positions.reshape(-1, 3) * Bohr
+    return HessianData(sections['Cartesian Force Constants'], 'lower', HARTREE_BOHR2,
+                       sections['Real atomic weights'], sections['Atomic numbers'], positions)
+
+
+def read_orca_hess(lines):
+    """
+    ORCA .hess file: the $hessian blocks and the symbols, masses and positions of $atoms.
+    """
+    hessian = masses = numbers = positions = None
+    lines = iter(lines)
+    for line in lines:
+        keyword = line.strip()
+        if keyword == '$hessian':
+            size = int(next(lines))
+            hessian = _read_column_blocks(lines, size, size)
+        elif keyword == '$atoms':
+            atoms = [next(lines).split() for _ in range(int(next(lines)))]
+            numbers = np.array([atomic_numbers[atom[0]] for atom in atoms])
+            masses = np.array([float(atom[1]) for atom in atoms])
+            positions = np.array([atom[2:5] for atom in atoms], dtype=float) * Bohr
+
+    if hessian is None:
+        raise ValueError("No $hessian block in the ORCA file.")
+    return HessianData(hessian, '2d', HARTREE_BOHR2, masses, numbers, positions)
+
+
+def read_fcm(lines):
+    """
+    CFOUR FCMFINAL or Psi4 file15.dat force constant matrix: the number of atoms and of
+    Cartesian coordinates, then the full matrix. The files hold no atom information.
+    """
+    lines = iter(lines)
+    n_atoms, n_dofs = (int(value) for value in next(lines).split()[:2])
+    if n_dofs != 3 * n_atoms:
+        raise ValueError("Not a force constant matrix file.")
+    hessian = _read_values(lines, n_dofs**2, float).reshape(n_dofs, n_dofs)
+    return HessianData(hessian, '2d', HARTREE_BOHR2, None, None, None)
+
+
+def read_qchem_output(lines):
+    """
+    Q-Chem output: the last 'Hessian of the SCF Energy' (or of the final energy) and the
+    atoms of the last 'Standard Nuclear Orientation'. Q-Chem prints no masses, so the ones
+    of the most common isotopes are given.
+    """
+    hessian = numbers = positions = None
+    lines = iter(lines)
+    for line in lines:
+        if 'Standard Nuclear Orientation' in line:
+            next(lines)
+            next(lines)
+            atoms = []
+            for atom_line in lines:
+                if atom_line.lstrip().startswith('---'):
+                    break
+                atoms.append(atom_line.split())
+            numbers = np.array([atomic_numbers[atom[1]] for atom in atoms])
+            positions = np.array([atom[2:5] for atom in atoms], dtype=float)
+        elif 'Hessian of the' in line and 'Energy' in line:
+            if positions is None:
+                raise ValueError("No Standard Nuclear Orientation before the Hessian.")
+            hessian = _read_column_blocks(lines, 3 * len(positions), 3 * len(positions))
+
+    if hessian is None:
+        raise ValueError("No Hessian in the Q-Chem output.")
+    return HessianData(hessian, '2d', HARTREE_BOHR2, atomic_masses[numbers], numbers,
+                       positions)
+
+
+def _read_values(lines, size, dtype):
+    values = []
+    for value in chain.from_iterable(line.split() for line in lines):
+        values.append(value)
+        if len(values) == size:
+            break
+    if len(values) != size:
+        raise ValueError("Unexpected end of the file.")
+    return np.array(values, dtype=dtype)
+
+
+def _read_column_blocks(lines, n_rows, n_cols):
+    """
+    Matrix printed in blocks of columns, each a line of column indices followed by one
+    line per row of the row index and the values in these columns.
+    """
+    matrix = np.empty((n_rows, n_cols))
+    col = 0
+    while col < n_cols:
+        header = next(lines).split()
+        while not header:
+            header = next(lines).split()
+        n_block = len(header)
+        for row in range(n_rows):
+            values = next(lines).split()[1:]
+            matrix[row, col:col + n_block] = [value.replace('D', 'E') for value in values]
+        col += n_block
+    return matrix
@@ -0,0 +1,257 @@
+"""
+Registry of the readers of single Hessian files.
+
+A format maps to a Reader whose function is given as 'module:function' and only imported
+when a file of the format is read, so that formats that are not used cost nothing at
+startup. Binary readers are called with a binary stream and the dtype (and the file name
+if named), text readers with a text stream, returning a HessianData (see qm_formats).
+The layout of the returned Hessians ('2d', 'upper', 'lower' or 'sparse') and their unit
+(None: given by the user) are fixed by the format.
+
+Further readers are registered by adding them to READERS or by other packages through
+entry points of the group 'hesmatch.readers', e.g.
+
+    [options.entry_points]
+    hesmatch.readers =
+        myformat = mypackage.io:read_hessian
+
+which are binary readers returning the full Hessian in the unit given by the user.
+"""
+import bz2
+import gzip
+import importlib
+import io
+import lzma
+import os
+import warnings
+from collections import namedtuple
+from functools import lru_cache
+import numpy as np
+from scipy.sparse import coo_matrix, load_npz
+from .hesmatch import HARTREE_BOHR2, KJ_MOL_NM2
+
+ENTRY_POINT_GROUP = 'hesmatch.readers'
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.xz': lzma.open, '.bz2': bz2.open}
+# Bytes of (decompressed) text parsed at a time
+CHUNK_SIZE = 2**22
+# Bytes read from the start of a file to look for magic bytes
+MAGIC_SIZE = 64
+
+Reader = namedtuple('Reader', ['target', 'layout', 'unit', 'extensions', 'magic', 'text',
+                               'named'])
+Reader.__new__.__defaults__ = ('2d', None, (), None, False, False)
+Reader.__doc__ = """
+Reader function ('module:function') of a format, the layout and unit (None: given by the
+user) of its Hessians, the file name endings and magic bytes (at the start of the file,
+after whitespace) of the format for detect_format, and whether the function reads text
+(returning a HessianData) or needs the file name.
+"""
+
+READERS = {
+    '2d': Reader('hesmatch.readers:read_2d_file'),
+    'upper': Reader('hesmatch.readers:read_1d_file', 'upper'),
+    'lower': Reader('hesmatch.readers:read_1d_file', 'lower'),
+    'sparse': Reader('hesmatch.readers:read_sparse_file', 'sparse', extensions=('.coo',),
+                     named=True),
+    'fchk': Reader('hesmatch.qm_formats:read_fchk', 'lower', HARTREE_BOHR2, ('.fchk', '.fch'),
+                   text=True),
+    'orca': Reader('hesmatch.qm_formats:read_orca_hess', '2d', HARTREE_BOHR2, ('.hess',),
+                   b'$orca_hessian_file', text=True),
+    'fcm': Reader('hesmatch.qm_formats:read_fcm', '2d', HARTREE_BOHR2,
+                  ('FCMFINAL', 'file15.dat'), text=True),
+    'qchem': Reader('hesmatch.qm_formats:read_qchem_output', '2d', HARTREE_BOHR2, text=True),
+    # Sparse storage is taken care of by the analysis
+    'mtx': Reader('hesmatch.gromacs:read_mtx', '2d', KJ_MOL_NM2, ('.mtx',),
+                  b'\x34\xce\x8f\xd2'),
+}
+
+
+def get_reader(hes_format):
+    """
+    Reader of a format of READERS or of the entry points.
+    """
+    if hes_format in READERS:
+        return READERS[hes_format]
+    plugins = _get_plugins()
+    if hes_format in plugins:
+        return plugins[hes_format]
+    available = ', '.join(list(READERS) + list(plugins))
+    raise ValueError(f"Unknown Hessian format '{hes_format}' (available: {available}).")
+
+
+def detect_format(file):
+    """
+    Format of a file (path) from the ending of its name, ignoring a compression extension,
+    or else from its magic bytes, or None if neither is known.
+    """
+    name = strip_compression(file)
+    for hes_format, reader in READERS.items():
+        if name.endswith(reader.extensions):
+            return hes_format
+
+    with open_hessian_file(file) as f:
+        head = f.read(MAGIC_SIZE).lstrip()
+    for hes_format, reader in READERS.items():
+        if reader.magic is not None and head.startswith(reader.magic):
+            return hes_format
+    return None
+
+
+def read_hessian_file(file, hes_format, dtype=float, name=None):
+    """
+    Read a single Hessian from a path or an open binary file, whose name is then given
+    by name.
+    """
+    reader = get_reader(hes_format)
+    if reader.text:
+        return read_qm_file(file, hes_format, dtype).hessian
+
+    if name is None:
+        name = file
+    if isinstance(file, str):
+        with open_hessian_file(file) as f:
+            return read_hessian_file(f, hes_format, dtype, name)
+
+    function = _load_function(reader.target)
+    if reader.named:
+        return function(file, dtype, name)
+    return function(file, dtype)
+
+
+def read_qm_file(file, qm_format, dtype=float):
+    """
+    HessianData (see qm_formats) of a file of a text format, e.g. of a QM program, from a
+    path or an open binary file.
+    """
+    if isinstance(file, str):
+        with open_hessian_file(file) as f:
+            return read_qm_file(f, qm_format, dtype)
+
+    text = io.TextIOWrapper(file)
+    try:
+        data = _load_function(get_reader(qm_format).target)(text)
+    finally:
+        # Leave the binary file open
+        text.detach()
+    return data._replace(hessian=data.hessian.astype(dtype, copy=False))
+
+
+@lru_cache(maxsize=None)
+def _load_function(target):
+    module, function = target.split(':')
+    return getattr(importlib.import_module(module), function)
+
+
+@lru_cache(maxsize=None)
+def _get_plugins():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # Python < 3.8
+        return {}
+
+    points = entry_points()
+    if hasattr(points, 'select'):
+        points = points.select(group=ENTRY_POINT_GROUP)
+    else:
+        points = points.get(ENTRY_POINT_GROUP, ())
+    return {point.name: Reader(point.value) for point in points}
+
+
+def open_hessian_file(file):
+    """
+    Binary stream of a file, decompressed on the fly if it ends in .gz, .xz or .bz2.
+    """
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(file)[1], open)
+    return opener(file, 'rb')
+
+
+def read_tokens(stream, dtype=float, chunk_size=CHUNK_SIZE):
+    """
+    Whitespace separated numbers of a binary stream as a 1D array. The stream is read and
+    parsed by numpy's text parser in chunks of chunk_size bytes, so that the text is
+    never held in memory as a whole.
+    """
+    arrays = []
+    rest = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        # The number at the end may continue in the next chunk
+        end = max(chunk.rfind(whitespace) for whitespace in (b' ', b'\n', b'\t', b'\r'))
+        rest = chunk[end + 1:]
+        arrays.append(_parse_tokens(chunk[:end + 1], dtype))
+    arrays.append(_parse_tokens(rest, dtype))
+    return np.concatenate(arrays)
+
+
+def _parse_tokens(text, dtype):
+    n_tokens = len(text.split())
+    if not n_tokens:
+        return np.empty(0, dtype=dtype)
+    try:
+        with warnings.catch_warnings():
+            # numpy stops at text that is not a number, which is caught by the count below
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = np.fromstring(text.decode(), dtype=dtype, sep=' ')
+    except ValueError:
+        values = None
+    if values is None or len(values) != n_tokens:
+        raise ValueError("Hessian files may only contain numbers.")
+    return values
+
+
+def strip_compression(file):
+    """
+    File name without a compression extension (.gz, .xz or .bz2).
+    """
+    root, extension = os.path.splitext(file)
+    return root if extension in COMPRESSED_OPENERS else file
+
+
+def read_2d_file(file, dtype=float):
+    if isinstance(file, str):
+        with open_hessian_file(file) as f:
+            return np.loadtxt(f, dtype=dtype)
+    return np.loadtxt(file, dtype=dtype)
+
+
+def read_sparse_file(file, dtype=float, name=None):
+    """
+    Read a sparse Hessian from a scipy.sparse .npz file, a binary .coo file of
+    (int64 row, int64 column, float64 value) records, or a text file of
+    "row column value" triplets. If only one triangle is given, it is mirrored.
+    File objects need the file name in name to tell the formats apart.
+    """
+    if name is None:
+        name = file
+    if isinstance(file, str):
+        with open_hessian_file(file) as f:
+            return read_sparse_file(f, dtype, name)
+    name = strip_compression(name)
+
+    if name.endswith('.npz'):
+        return load_npz(file).tocoo().astype(dtype)
+
+    if name.endswith('.coo'):
+        record = np.dtype([('row', '<i8'), ('col', '<i8'), ('value', '<f8')])
+        triplets = np.frombuffer(file.read(), dtype=record)
+        rows, cols, values = triplets['row'], triplets['col'], triplets['value']
+    else:
+        triplets = np.loadtxt(file, ndmin=2)
+        rows, cols, values = triplets[:, 0].astype(int), triplets[:, 1].astype(int), triplets[:, 2]
+
+    if (rows >= cols).all() or (rows <= cols).all():
+        off_diagonal = rows != cols
+        rows, cols = np.append(rows, cols[off_diagonal]), np.append(cols, rows[off_diagonal])
+        values = np.append(values, values[off_diagonal])
+
+    return coo_matrix((values, (rows, cols)), dtype=dtype)
+
+
+def read_1d_file(file, dtype=float):
+    if isinstance(file, str):
+        with open_hessian_file(file) as f:
+            return read_tokens(f, dtype)
+    return read_tokens(file, dtype)
@@ -0,0 +1,96 @@
+import os
+from contextlib import contextmanager
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# Degrees of freedom below which an additional BLAS thread does not pay off in eigh
+DOFS_PER_BLAS_THREAD = 600
+
+
+def get_n_cpus():
+    """
+    Number of CPUs available to this process.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def plan_workers(n_dofs, n_cpus=None, n_procs=None, blas_threads=None):
+    """
+    Split the CPUs between worker processes and BLAS threads per worker for Hessians with
+    n_dofs degrees of freedom. Small Hessians run one single-threaded eigh per CPU, while
+    larger ones get one BLAS thread per DOFS_PER_BLAS_THREAD degrees of freedom and
+    correspondingly fewer processes, up to a single process using all CPUs. The product
+    of both never exceeds n_cpus, unless both are given.
+
+    Parameters
+    ----------
+    n_dofs : int
+        Size of the (mass-weighted) Hessians.
+    n_cpus : int, optional
+        The default is None, the CPUs available to this process.
+    n_procs, blas_threads : int, optional
+        Fix the number of processes or BLAS threads per process, and plan the other.
+
+    Returns
+    -------
+    n_procs : int
+    blas_threads : int
+
+    """
+    if n_cpus is None:
+        n_cpus = get_n_cpus()
+
+    if blas_threads is None:
+        if n_procs is None:
+            blas_threads = min(max(n_dofs // DOFS_PER_BLAS_THREAD, 1), n_cpus)
+        else:
+            blas_threads = max(n_cpus // n_procs, 1)
+    if n_procs is None:
+        n_procs = max(n_cpus // blas_threads, 1)
+
+    return n_procs, blas_threads
+
+
+def can_limit_blas_threads():
+    """
+    Whether threadpoolctl, which limits the BLAS threads, is installed.
+    """
+    return threadpool_limits is not None
+
+
+def check_blas_threads(n_threads):
+    """
+    Raise an ImportError if n_threads is given but threadpoolctl is not installed.
+    """
+    if n_threads is not None and not can_limit_blas_threads():
+        raise ImportError("Limiting the number of BLAS threads requires threadpoolctl.")
+
+
+def set_blas_threads(n_threads):
+    """
+    Limit the number of BLAS threads of this process for the rest of its lifetime, e.g. in
+    a worker process. Requires threadpoolctl.
+    """
+    check_blas_threads(n_threads)
+    threadpool_limits(limits=n_threads, user_api='blas')
+
+
+@contextmanager
+def limit_blas_threads(n_threads):
+    """
+    Limit the number of BLAS threads within the context, requires threadpoolctl. Does
+    nothing if n_threads is None.
+    """
+    if n_threads is None:
+        yield
+        return
+
+    check_blas_threads(n_threads)
+    with threadpool_limits(limits=n_threads, user_api='blas'):
+        yield
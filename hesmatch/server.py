@@ -0,0 +1,143 @@
+import os
+import socket
+import sys
+from contextlib import contextmanager
+from .context import AnalysisContext
+from .hesmatch import do_vibrational_analysis
+from .matching import _get_vibrations, match_to_reference
+from .protocol import decode_array, read_frame, write_frame, write_result
+
+
+class MatchServer:
+    """
+    Reference analysis kept in memory to match Hessians against, for long-running
+    processes that receive the match Hessians one at a time, see serve_stream and
+    serve_socket.
+
+    Parameters
+    ----------
+    ref_hessian : Numpy array
+    masses, ref_format, match_format, ref_unit, match_unit, degenerate_tol, positions,
+    precision :
+        See hesmatch.hesmatch.
+
+    """
+
+    def __init__(self, ref_hessian, masses=None, ref_format='2d', match_format='2d',
+                 ref_unit=1, match_unit=1, degenerate_tol=None, positions=None,
+                 precision='double'):
+        self.match_format = match_format
+        self.match_unit = match_unit
+        self.degenerate_tol = degenerate_tol
+        self.precision = precision
+        self.masses = masses
+        self.positions = positions
+
+        self.context = AnalysisContext.from_hessian(ref_hessian, ref_format, masses, positions)
+        self.internal_basis = None
+        if positions is not None:
+            self.internal_basis = self.context.get_internal_basis()
+
+        ref = do_vibrational_analysis(ref_hessian, ref_format, ref_unit, masses, positions,
+                                      self.internal_basis, precision=precision,
+                                      context=self.context)
+        self.n_rigid = ref.get_n_rigid()
+        self.ref_freqs, self.ref_modes = _get_vibrations(ref)
+
+    def match(self, hessian, hes_format=None, unit=None):
+        """
+        Chosen overlaps, frequency differences and error of a match Hessian, given in the
+        match format and unit of the server unless specified.
+        """
+        hes_format = self.match_format if hes_format is None else hes_format
+        unit = self.match_unit if unit is None else unit
+        match = do_vibrational_analysis(hessian, hes_format, unit, self.masses, self.positions,
+                                        self.internal_basis, precision=self.precision,
+                                        context=self.context, n_rigid=self.n_rigid)
+        return match_to_reference(self.ref_freqs, self.ref_modes, match, self.degenerate_tol)
+
+
+def serve_stream(server, instream, outstream):
+    """
+    Answer the array frames (see protocol) of a binary input stream with result frames, or
+    error frames for failed requests, on a binary output stream until an end frame or the
+    end of the input. The 'id' of a request is returned with its result, and its 'format'
+    and 'unit' override the ones of the server.
+
+    Returns
+    -------
+    bool
+        Whether a shutdown frame was received.
+
+    """
+    while True:
+        frame = read_frame(instream)
+        if frame is None:
+            return False
+
+        metadata, payload = frame
+        if metadata['type'] == 'shutdown':
+            return True
+        if metadata['type'] == 'end':
+            return False
+
+        reply = {'id': metadata.get('id')}
+        try:
+            if metadata['type'] != 'array':
+                raise ValueError(f"Unexpected frame type '{metadata['type']}'.")
+            hessian = decode_array(metadata, payload)
+            result = server.match(hessian, metadata.get('format'), metadata.get('unit'))
+        except Exception as error:
+            write_frame(outstream, dict(reply, type='error', message=str(error)))
+        else:
+            write_result(outstream, result, **reply)
+
+
+@contextmanager
+def reserve_stdout():
+    """
+    Redirect the standard output of this process, including the one of subprocesses such
+    as the CBC solver, to stderr within the context, and yield a binary stream to the
+    original stdout, which then only carries frames.
+    """
+    sys.stdout.flush()
+    stdout_fd = sys.stdout.fileno()
+    saved_fd = os.dup(stdout_fd)
+    os.dup2(sys.stderr.fileno(), stdout_fd)
+    try:
+        with os.fdopen(os.dup(saved_fd), 'wb') as outstream:
+            yield outstream
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_fd, stdout_fd)
+        os.close(saved_fd)
+
+
+def serve_stdio(server):
+    """
+    Serve the frames of stdin on stdout, see reserve_stdout.
+    """
+    with reserve_stdout() as outstream:
+        serve_stream(server, sys.stdin.buffer, outstream)
+
+
+def serve_socket(server, path):
+    """
+    Serve the connections to a Unix socket at path one after the other, each with
+    serve_stream, until a connection sends a shutdown frame.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(path)
+        listener.listen()
+        try:
+            shutdown = False
+            while not shutdown:
+                connection, _ = listener.accept()
+                with connection, connection.makefile('rb') as instream, \
+                        connection.makefile('wb') as outstream:
+                    shutdown = serve_stream(server, instream, outstream)
+        finally:
+            os.remove(path)
@@ -0,0 +1,144 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.sparse import issparse
+from .context import AnalysisContext
+from .matching import _get_vibrations, match_to_reference
+from .scheduler import get_n_cpus, set_blas_threads
+
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:  # Python < 3.8
+    SharedMemory = None
+
+_worker = {}
+
+
+def share_array(array):
+    """
+    Copy an array into a new shared memory block. Returns the block, which the caller
+    has to close and unlink, and the handle with which other processes attach to it.
+    """
+    if SharedMemory is None:
+        raise RuntimeError("Shared memory transport requires Python 3.8 or newer.")
+
+    array = np.asarray(array)
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(handle):
+    """
+    Attach to an array shared by share_array without copying it. Returns the block,
+    which has to be closed once the array is no longer used, and the array.
+    """
+    name, shape, dtype = handle
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype, buffer=shm.buf)
+
+
+def match_in_processes(ref, match_hessians, analysis, degenerate_tol=None, n_procs=None,
+                       blas_threads=None):
+    """
+    Analyse the match Hessians and match them to ref in a pool of n_procs processes, and
+    yield the chosen overlaps, frequency differences and errors in order, each with the
+    largest frequency error bound of the match analysis (None unless it is refined).
+
+    The reference frequencies and modes and the internal basis are published once in
+    shared memory, and every dense match Hessian is passed to the workers as a shared
+    memory handle instead of being pickled. Sparse Hessians are pickled. At most
+    2 * n_procs Hessians are in flight.
+
+    Parameters
+    ----------
+    ref : VibrationsData
+    match_hessians : iterable of Numpy arrays
+    analysis : dict
+        Keyword arguments of hesmatch.do_vibrational_analysis, with masses and positions.
+    degenerate_tol : float, optional
+        See matching.match_to_reference.
+    n_procs : int, optional
+        Number of worker processes. The default is None, the number of CPUs.
+    blas_threads : int, optional
+        Number of BLAS threads of each worker, see scheduler.set_blas_threads. The default
+        is None, which leaves it to the BLAS library.
+
+    """
+    if n_procs is None:
+        n_procs = get_n_cpus()
+    n_atoms = len(ref.get_atoms())
+    ref_freqs, ref_modes = _get_vibrations(ref)
+    published = [share_array(ref_freqs), share_array(ref_modes)]
+    if analysis.get('internal_basis') is not None:
+        published.append(share_array(analysis['internal_basis']))
+        analysis = dict(analysis, internal_basis=None)
+    handles = [handle for _, handle in published]
+
+    try:
+        with ProcessPoolExecutor(n_procs, initializer=_init_worker,
+                                 initargs=(handles, n_atoms, analysis,
+                                           degenerate_tol, blas_threads)) as executor:
+            pending = deque()
+            for hessian in match_hessians:
+                pending.append(_submit(executor, hessian))
+                if len(pending) >= 2 * n_procs:
+                    yield _collect(*pending.popleft())
+            while pending:
+                yield _collect(*pending.popleft())
+    finally:
+        for shm, _ in published:
+            shm.close()
+            shm.unlink()
+
+
+def _submit(executor, hessian):
+    if issparse(hessian):
+        return executor.submit(_match_worker, hessian), None
+    shm, handle = share_array(hessian)
+    return executor.submit(_match_worker, handle), shm
+
+
+def _collect(future, shm):
+    try:
+        return future.result()
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+
+def _init_worker(handles, n_atoms, analysis, degenerate_tol, blas_threads):
+    if blas_threads is not None:
+        set_blas_threads(blas_threads)
+
+    blocks, arrays = zip(*(attach_array(handle) for handle in handles))
+    _worker['blocks'] = blocks
+    _worker['ref_freqs'], _worker['ref_modes'] = arrays[:2]
+    _worker['internal_basis'] = arrays[2] if len(arrays) > 2 else None
+    _worker['analysis'] = analysis
+    _worker['degenerate_tol'] = degenerate_tol
+    _worker['context'] = AnalysisContext(analysis['masses'], n_atoms, analysis['positions'])
+
+
+def _match_worker(hessian):
+    if issparse(hessian):
+        return _analyse_and_match(hessian)
+
+    shm, hessian = attach_array(hessian)
+    try:
+        return _analyse_and_match(hessian)
+    finally:
+        del hessian
+        shm.close()
+
+
+def _analyse_and_match(hessian):
+    from .hesmatch import _get_error_bound, do_vibrational_analysis
+
+    analysis = dict(_worker['analysis'], internal_basis=_worker['internal_basis'],
+                    context=_worker['context'])
+    match = do_vibrational_analysis(hessian, **analysis)
+    result = match_to_reference(_worker['ref_freqs'], _worker['ref_modes'], match,
+                                _worker['degenerate_tol'])
+    return result, _get_error_bound(match)
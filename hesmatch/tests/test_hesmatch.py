@@ -5,6 +5,7 @@ Unit and regression test for the hesmatch package.
 # Import package, test suite, and other packages as needed
 import sys
 
+import numpy as np
 import pytest
 
 import hesmatch
@@ -13,3 +14,911 @@ import hesmatch
 def test_hesmatch_imported():
     """Sample test, will always pass so long as import statement worked."""
     assert "hesmatch" in sys.modules
+
+
+def test_solve_assignments():
+    from scipy.optimize import linear_sum_assignment
+    from hesmatch.matching import solve_assignments
+
+    rng = np.random.default_rng(0)
+    costs = rng.random((5, 8, 8))
+    costs[0] = np.diag(np.full(8, -1.0)) + costs[0]  # row-wise minimum is a permutation
+
+    permutations = solve_assignments(costs, n_jobs=2)
+
+    assert permutations.shape == (5, 8)
+    for cost, perm in zip(costs, permutations):
+        assert np.array_equal(perm, linear_sum_assignment(cost)[1])
+
+
+def test_sweep_weights():
+    from hesmatch.matching import sweep_weights
+
+    overlap_matrix = np.array([[0.9, 0.6],
+                               [0.4, 0.8]])
+    ref_freqs = np.array([100., 200.])
+    match_freqs = np.array([205., 95.])
+
+    assignments, changes = sweep_weights(overlap_matrix, ref_freqs, match_freqs,
+                                         [1000, 100, 1, 0.1])
+
+    assert np.array_equal(assignments[0], [0, 1])
+    assert np.array_equal(assignments[-1], [1, 0])
+    assert len(changes) == 1
+
+
+def test_do_subspace_matching():
+    from hesmatch.matching import do_subspace_matching, normalize_modes
+
+    rng = np.random.default_rng(1)
+    ref_modes = normalize_modes(np.linalg.qr(rng.normal(size=(9, 9)))[0].reshape(9, 3, 3))
+    ref_freqs = np.array([100., 200., 200.2, 300., 400., 400.1, 400.3, 500., 600.])
+
+    # Mix the modes inside each degenerate subspace, the matching should undo it
+    angle = 0.6
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    match_modes = ref_modes.copy()
+    match_modes[1:3] = np.einsum('ij,jkl->ikl', rotation, ref_modes[1:3])
+    match_modes[4:6] = np.einsum('ij,jkl->ikl', rotation, ref_modes[4:6])
+
+    chosen_overlaps, match_freqs, match_modes = do_subspace_matching(ref_freqs, ref_modes,
+                                                                     ref_freqs, match_modes)
+
+    assert np.allclose(chosen_overlaps, 1)
+    assert np.allclose(match_modes, ref_modes)
+    assert np.allclose(match_freqs, ref_freqs, atol=0.5)
+
+
+def spring_hessian(positions, k=500.):
+    """Hessian of a fully connected network of springs at rest at the given geometry."""
+    n_atoms = len(positions)
+    hessian = np.zeros((n_atoms, 3, n_atoms, 3))
+    for i in range(n_atoms):
+        for j in range(i):
+            bond = positions[i] - positions[j]
+            block = k * np.outer(bond, bond) / bond.dot(bond)
+            hessian[i, :, j] -= block
+            hessian[j, :, i] -= block
+            hessian[i, :, i] += block
+            hessian[j, :, j] += block
+    return hessian.reshape(3*n_atoms, 3*n_atoms)
+
+
+@pytest.mark.parametrize('positions, n_rigid', [
+    (np.array([[0., 0., 0.], [0.96, 0., 0.], [-0.24, 0.93, 0.], [0.2, 0.3, 0.8]]), 6),
+    (np.array([[0., 0., 0.], [1.16, 0., 0.], [-1.16, 0., 0.]]), 5),
+])
+def test_internal_basis(positions, n_rigid):
+    from hesmatch.hesmatch import do_vibrational_analysis
+    from hesmatch.hessian import get_internal_basis
+    from ase import Atoms
+
+    masses = np.array([12., 16., 16., 1.])[:len(positions)]
+    hessian = spring_hessian(positions)
+    basis = get_internal_basis(Atoms(masses=masses, positions=positions))
+
+    full = do_vibrational_analysis(hessian.copy(), '2d', 1, masses)
+    projected = do_vibrational_analysis(hessian.copy(), '2d', 1, masses, positions, basis)
+
+    assert basis.shape == (3*len(positions), 3*len(positions) - n_rigid)
+    assert projected.get_n_rigid() == 0
+    assert projected.get_rigid_body_contamination() < 1e-10
+    assert np.allclose(projected.get_frequencies().real, full.get_frequencies().real[n_rigid:],
+                       atol=1e-3)
+
+
+def test_linear_without_geometry(capsys):
+    from hesmatch.hesmatch import do_vibrational_analysis
+    from hesmatch.hessian import get_internal_basis
+    from ase import Atoms
+
+    positions = np.array([[0., 0., 0.], [1.16, 0., 0.], [-1.16, 0., 0.]])
+    masses = np.array([12., 16., 16.])
+    basis = get_internal_basis(Atoms(masses=masses, positions=positions))
+    omega2 = np.array([0.5, 0.5, 1., 2.])
+    weights = np.repeat(masses**0.5, 3)
+    hessian = weights[:, np.newaxis] * (basis * omega2) @ basis.T * weights
+
+    # Without a geometry the count does not depend on the spectrum
+    vib_data = do_vibrational_analysis(hessian, '2d', 1, masses)
+    assert vib_data.get_n_rigid() == 6
+    with_geometry = do_vibrational_analysis(hessian, '2d', 1, masses, positions)
+    assert with_geometry.get_n_rigid() == 5
+    assert capsys.readouterr().out == ''
+
+
+def test_rigid_count_of_matches(capsys):
+    from hesmatch.hesmatch import hesmatch, do_vibrational_analysis
+    from hesmatch.hessian import get_rigid_body_basis
+    from hesmatch.matching import _get_vibrations, match_to_reference
+    from ase import Atoms
+
+    positions = np.random.default_rng(5).normal(size=(5, 3))
+    hessian = spring_hessian(positions)
+    # A match whose rotation is pushed into the vibrational spectrum
+    rotation = get_rigid_body_basis(Atoms(masses=np.ones(5), positions=positions))[:, 3]
+    match = hessian + 5. * np.outer(rotation, rotation)
+
+    # The spectral gap of the match alone would leave the rotation out of the rigid modes
+    hesmatch(hessian, [match, hessian])
+    assert capsys.readouterr().out.count('[1. 1. 1. 1. 1. 1. 1. 1. 1.]') == 2
+
+    ref_freqs, ref_modes = _get_vibrations(do_vibrational_analysis(hessian, '2d', 1, None))
+    fewer = do_vibrational_analysis(match, '2d', 1, None, n_rigid=5)
+    with pytest.raises(ValueError, match='rigid-body modes'):
+        match_to_reference(ref_freqs, ref_modes, fewer)
+
+
+def test_partial_hessian():
+    from hesmatch.hessian import get_partial_hessian, triangle_to_2d
+
+    rng = np.random.default_rng(2)
+    positions = rng.normal(size=(5, 3))
+    hessian = spring_hessian(positions)
+    indices = [1, 3, 4]
+    dofs = [3, 4, 5, 9, 10, 11, 12, 13, 14]
+
+    assert np.array_equal(triangle_to_2d(hessian[np.tril_indices(15)]), hessian)
+    assert np.array_equal(triangle_to_2d(hessian[np.triu_indices(15)], lower=False), hessian)
+    assert np.array_equal(get_partial_hessian(hessian, indices), hessian[np.ix_(dofs, dofs)])
+
+    # The relaxed environment keeps the translations of the subset as zero modes
+    schur = get_partial_hessian(hessian, indices, 'schur')
+    translation = np.tile(np.eye(3), 3).T
+    assert np.allclose(schur @ translation, 0)
+
+
+def test_unsorted_indices():
+    from hesmatch.hesmatch import do_vibrational_analysis
+
+    positions = np.random.default_rng(2).normal(size=(5, 3))
+    hessian = spring_hessian(positions)
+    masses = np.array([1., 2., 3., 4., 5.])
+    ordered = do_vibrational_analysis(hessian, '2d', 1, masses, indices=[1, 3])
+    unordered = do_vibrational_analysis(hessian, '2d', 1, masses, indices=[3, 1])
+    assert np.allclose(unordered.get_frequencies(), ordered.get_frequencies())
+    with pytest.raises(ValueError, match='repeat'):
+        do_vibrational_analysis(hessian, '2d', 1, masses, indices=[1, 3, 1])
+
+
+def test_fragments():
+    from hesmatch.hesmatch import do_vibrational_analysis
+    from hesmatch.hessian import find_fragments
+
+    rng = np.random.default_rng(3)
+    hessian = np.zeros((18, 18))
+    hessian[:9, :9] = spring_hessian(rng.normal(size=(3, 3)))
+    hessian[9:, 9:] = spring_hessian(rng.normal(size=(3, 3)))
+    order = np.array([0, 3, 1, 4, 2, 5])  # interleave the atoms of the two fragments
+    dofs = (3 * order[:, np.newaxis] + np.arange(3)).ravel()
+    hessian = hessian[np.ix_(dofs, dofs)]
+    masses = np.array([12., 16., 1., 14., 1., 32.])
+
+    assert len(find_fragments(hessian)) == 2
+
+    full = do_vibrational_analysis(hessian.copy(), '2d', 1, masses)
+    split = do_vibrational_analysis(hessian.copy(), '2d', 1, masses, fragments=True)
+    assert np.allclose(split.get_frequencies().real, full.get_frequencies().real, atol=1e-3)
+    # Six rigid-body modes per fragment
+    assert split.get_n_rigid() == 12
+
+
+def test_sparse_partial_spectrum():
+    from scipy.sparse import coo_matrix
+    from hesmatch.hesmatch import do_vibrational_analysis
+
+    rng = np.random.default_rng(4)
+    hessian = spring_hessian(rng.normal(size=(6, 3)))
+    masses = np.array([12., 16., 1., 14., 1., 32.])
+
+    full = do_vibrational_analysis(hessian.copy(), '2d', 1, masses)
+    sparse = do_vibrational_analysis(coo_matrix(hessian), 'sparse', 1, masses)
+    freqs = full.get_frequencies().real
+    assert np.allclose(sparse.get_frequencies().real, freqs, atol=1e-3)
+
+    partial = do_vibrational_analysis(coo_matrix(hessian), 'sparse', 1, masses, n_modes=3,
+                                      target_freq=freqs[10])
+    assert partial.get_n_rigid() == 0
+    assert np.allclose(partial.get_frequencies().real, freqs[9:12])
+
+
+@pytest.mark.parametrize('hes_format', ['lower', 'upper'])
+def test_packed_hessian(hes_format):
+    from hesmatch.hesmatch import do_vibrational_analysis
+
+    rng = np.random.default_rng(5)
+    hessian = spring_hessian(rng.normal(size=(4, 3)))
+    masses = np.array([12., 16., 1., 14.])
+    triangle = np.tril_indices(12) if hes_format == 'lower' else np.triu_indices(12)
+
+    full = do_vibrational_analysis(hessian.copy(), '2d', 1, masses)
+    packed = do_vibrational_analysis(hessian[triangle], hes_format, 1, masses)
+
+    assert np.allclose(packed.get_hessian_2d(), full.get_hessian_2d())
+    assert np.allclose(packed.get_frequencies().real, full.get_frequencies().real, atol=1e-3)
+    assert np.allclose(np.abs(packed.get_modes()[6:]), np.abs(full.get_modes()[6:]))
+
+
+def test_single_precision_refinement():
+    from hesmatch.hesmatch import do_vibrational_analysis
+
+    rng = np.random.default_rng(6)
+    hessian = spring_hessian(rng.normal(size=(6, 3)))
+    hessian += 1e-3 * rng.normal(size=hessian.shape)
+    hessian += hessian.T
+    masses = np.array([12., 16., 1., 14., 1., 32.])
+
+    double = do_vibrational_analysis(hessian, '2d', 1, masses)
+    single = do_vibrational_analysis(hessian, '2d', 1, masses, precision='single',
+                                     refine=True)
+    assert single.get_modes().dtype == np.float32
+
+    error_bound = single.get_frequency_error_bound()
+    error = np.abs(single.get_frequencies().real - double.get_frequencies().real)
+    assert np.all(error[6:] <= error_bound[6:] + 1e-9)
+    assert np.allclose(single.get_frequencies().real[6:], double.get_frequencies().real[6:],
+                       rtol=1e-7)
+
+
+def test_refined_error_bound(tmp_path, capsys):
+    from hesmatch.cache import DiskCache
+    from hesmatch.hesmatch import hesmatch, do_vibrational_analysis
+
+    geometry = np.random.default_rng(6).normal(size=(4, 3))
+    ref_hessian = spring_hessian(geometry)
+    match_hessian = spring_hessian(geometry, 450.)
+    cache = DiskCache(str(tmp_path))
+
+    hesmatch(ref_hessian, [match_hessian, match_hessian], precision='single', refine=True,
+             cache=cache)
+    output = capsys.readouterr().out
+    assert output.count('Frequency error bound') == 2
+    hesmatch(ref_hessian, [match_hessian], precision='single', refine=True, cache=cache)
+    assert output.startswith(capsys.readouterr().out)
+
+    # The analysis cache keeps the bound
+    def analyse(cache=None):
+        return do_vibrational_analysis(match_hessian, '2d', 1, None, precision='single',
+                                       refine=True, cache=cache).get_frequency_error_bound()
+
+    analyse(cache)
+    assert np.allclose(analyse(cache), analyse())
+
+
+@pytest.mark.parametrize('order', ['C', 'F'])
+def test_analysis_does_not_modify_input(order):
+    from ase.units import kJ, mol
+    from hesmatch.hesmatch import do_vibrational_analysis
+
+    rng = np.random.default_rng(7)
+    hessian = np.array(spring_hessian(rng.normal(size=(4, 3))), order=order)
+    original = hessian.copy()
+    masses = np.array([12., 16., 1., 14.])
+
+    first = do_vibrational_analysis(hessian, '2d', 1, masses)
+    second = do_vibrational_analysis(hessian, '2d', 1, masses)
+
+    assert np.array_equal(hessian, original)
+    assert np.allclose(first.get_frequencies(), second.get_frequencies())
+    assert np.allclose(first.get_hessian_2d(), original * kJ / mol)
+
+
+def test_analysis_context():
+    from hesmatch.context import AnalysisContext
+    from hesmatch.hesmatch import do_vibrational_analysis
+
+    rng = np.random.default_rng(8)
+    hessian = spring_hessian(rng.normal(size=(4, 3)))
+    masses = np.array([12., 16., 1., 14.])
+    context = AnalysisContext(masses)
+
+    for hes_format, triangle in [('2d', Ellipsis), ('lower', np.tril_indices(12)),
+                                 ('upper', np.triu_indices(12))]:
+        plain = do_vibrational_analysis(hessian[triangle], hes_format, 1, masses)
+        shared = do_vibrational_analysis(hessian[triangle], hes_format, 1, masses, context=context)
+        assert np.allclose(shared.get_frequencies(), plain.get_frequencies())
+
+    # Without masses the analysis is not mass-weighted
+    unweighted = do_vibrational_analysis(hessian, '2d', 1, None)
+    assert np.allclose(unweighted.get_atoms().get_masses(), 1)
+
+
+@pytest.mark.parametrize('positions', [None, 'geometry'])
+def test_isotopologues(positions):
+    from hesmatch.hesmatch import do_isotopologue_analysis, do_vibrational_analysis
+    from hesmatch.hessian import get_internal_basis
+    from ase import Atoms
+
+    rng = np.random.default_rng(9)
+    geometry = rng.normal(size=(4, 3))
+    positions = geometry if positions else None
+    hessian = spring_hessian(geometry)
+    mass_sets = np.array([[12., 16., 1., 14.], [13., 16., 2., 14.], [12., 18., 1., 15.]])
+
+    batched = do_isotopologue_analysis(hessian, '2d', 1, mass_sets, positions, batch_size=2)
+    for masses, vib_data in zip(mass_sets, batched):
+        internal_basis = None
+        if positions is not None:
+            internal_basis = get_internal_basis(Atoms(masses=masses, positions=positions))
+        single = do_vibrational_analysis(hessian, '2d', 1, masses, positions, internal_basis)
+        n_rigid = single.get_n_rigid()
+        assert np.allclose(vib_data.get_frequencies()[n_rigid:],
+                           single.get_frequencies()[n_rigid:])
+
+
+def test_isotopologue_options():
+    from hesmatch.cli import check_isotopologue_options
+
+    check_isotopologue_options('masses.txt', fragments=False, n_modes=None)
+    with pytest.raises(ValueError, match='mass_file'):
+        check_isotopologue_options(None)
+    with pytest.raises(ValueError, match='n_modes'):
+        check_isotopologue_options('masses.txt', fragments=False, n_modes=5)
+
+
+def test_iter_hessians(tmp_path):
+    import tarfile
+    from hesmatch.cli import check_sources, iter_hessians
+
+    rng = np.random.default_rng(10)
+    hessians = [spring_hessian(rng.normal(size=(3, 3))) for _ in range(3)]
+    for i, hessian in enumerate(hessians):
+        np.savetxt(tmp_path / f'{i}.dat', hessian)
+    with tarfile.open(tmp_path / 'hessians.tar.gz', 'w:gz') as archive:
+        for i in range(3):
+            archive.add(tmp_path / f'{i}.dat', arcname=f'{i}.dat')
+    np.savez(tmp_path / 'hessians.npz', *hessians)
+
+    sources = [str(tmp_path / '*.dat'), str(tmp_path / 'hessians.tar.gz'),
+               str(tmp_path / 'hessians.npz')]
+    read = iter_hessians(sources, '2d')
+    assert not isinstance(read, list)
+    read = list(read)
+    assert len(read) == 9
+    for i, hessian in enumerate(read):
+        assert np.allclose(hessian, hessians[i % 3])
+
+    lower = list(iter_hessians([str(tmp_path / 'hessians.tar.gz')], 'lower'))
+    assert np.allclose(lower[0], hessians[0].ravel())
+
+    check_sources(sources + ['-'])
+    for missing in ['missing.dat', str(tmp_path / '*.missing')]:
+        with pytest.raises(FileNotFoundError):
+            check_sources(sources + [missing])
+
+
+def test_pipeline():
+    from hesmatch.pipeline import prefetch, map_ordered
+
+    assert list(prefetch(iter(range(50)), 3)) == list(range(50))
+    assert list(map_ordered(lambda x: x**2, prefetch(range(50)), n_jobs=4)) == \
+        [x**2 for x in range(50)]
+
+    def failing():
+        yield 1
+        raise ValueError('unreadable')
+
+    with pytest.raises(ValueError):
+        list(prefetch(failing()))
+
+
+def test_threaded_analysis(monkeypatch):
+    import threading
+    from hesmatch.hessian import VibrationsData
+
+    rng = np.random.default_rng(20)
+    geometry = rng.normal(size=(4, 3))
+    match_hessians = [spring_hessian(geometry, k) for k in (400., 450., 550., 600.)]
+    threads = []
+    diagonalize = VibrationsData._diagonalize
+
+    def recording_diagonalize(self):
+        threads.append(threading.current_thread())
+        return diagonalize(self)
+
+    monkeypatch.setattr(VibrationsData, '_diagonalize', recording_diagonalize)
+    hesmatch.hesmatch(spring_hessian(geometry), match_hessians, n_jobs=2)
+    # The reference is diagonalized in the main thread, the matches in the pool
+    assert len(threads) == 5
+    assert threads[0] is threading.main_thread()
+    assert all(thread is not threading.main_thread() for thread in threads[1:])
+
+
+def test_match_in_processes():
+    from hesmatch.hesmatch import do_vibrational_analysis
+    from hesmatch.matching import _get_vibrations, match_to_reference
+    from hesmatch.shared import match_in_processes
+
+    rng = np.random.default_rng(11)
+    geometry = rng.normal(size=(4, 3))
+    masses = np.array([12., 16., 1., 14.])
+    ref_hessian = spring_hessian(geometry)
+    match_hessians = [spring_hessian(geometry, k) for k in (400., 450., 550.)]
+
+    ref = do_vibrational_analysis(ref_hessian, '2d', 1, masses)
+    analysis = dict(hes_format='2d', unit=1, masses=masses, positions=None)
+    results = list(match_in_processes(ref, match_hessians, analysis, n_procs=2))
+
+    ref_freqs, ref_modes = _get_vibrations(ref)
+    assert len(results) == len(match_hessians)
+    for match_hessian, (result, error_bound) in zip(match_hessians, results):
+        chosen_overlaps, diff, error = result
+        assert error_bound is None
+        match = do_vibrational_analysis(match_hessian, '2d', 1, masses)
+        expected = match_to_reference(ref_freqs, ref_modes, match)
+        assert np.allclose(chosen_overlaps, expected[0])
+        assert np.allclose(diff, expected[1])
+
+
+def test_plan_workers():
+    from hesmatch.scheduler import plan_workers
+
+    assert plan_workers(30, n_cpus=16) == (16, 1)
+    assert plan_workers(3000, n_cpus=16) == (3, 5)
+    assert plan_workers(30000, n_cpus=16) == (1, 16)
+    assert plan_workers(30, n_cpus=16, n_procs=4) == (4, 4)
+    assert plan_workers(30000, n_cpus=16, blas_threads=2) == (8, 2)
+
+
+def test_processes_split_cpus(monkeypatch):
+    from contextlib import nullcontext
+
+    hesmatch_module = sys.modules['hesmatch.hesmatch']
+    monkeypatch.setattr(sys.modules['hesmatch.scheduler'], 'get_n_cpus', lambda: 8)
+    monkeypatch.setattr(hesmatch_module, 'can_limit_blas_threads', lambda: True)
+    monkeypatch.setattr(hesmatch_module, 'limit_blas_threads', nullcontext)
+    workers = []
+
+    def match_in_processes(ref, match_hessians, analysis, degenerate_tol, n_procs,
+                           blas_threads):
+        workers.append((n_procs, blas_threads))
+        return iter(())
+
+    monkeypatch.setattr(hesmatch_module, 'match_in_processes', match_in_processes)
+    hessian = spring_hessian(np.random.default_rng(21).normal(size=(3, 3)))
+    hesmatch_module.hesmatch(hessian, [], n_procs=4)
+    hesmatch_module.hesmatch(hessian, [], n_procs='auto')
+    assert workers == [(4, 2), (8, 1)]
+
+
+def test_blas_threads_require_threadpoolctl(monkeypatch):
+    scheduler = sys.modules['hesmatch.scheduler']
+    monkeypatch.setattr(scheduler, 'threadpool_limits', None)
+    hessian = spring_hessian(np.random.default_rng(21).normal(size=(3, 3)))
+
+    with pytest.raises(ImportError, match='threadpoolctl'):
+        hesmatch.hesmatch(hessian, [hessian], blas_threads=2)
+    with scheduler.limit_blas_threads(None):
+        pass
+
+
+def test_journal(tmp_path, capsys):
+    from hesmatch.hesmatch import hesmatch
+    from hesmatch.journal import consolidate_journals, read_journal
+
+    rng = np.random.default_rng(12)
+    geometry = rng.normal(size=(4, 3))
+    ref_hessian = spring_hessian(geometry)
+    match_hessians = [spring_hessian(geometry, k) for k in (400., 450., 550.)]
+    journal = str(tmp_path / 'journal.jsonl')
+
+    hesmatch(ref_hessian, match_hessians[:2], journal=journal)
+    # Simulate a crash while writing the next entry
+    with open(journal, 'a') as f:
+        f.write('{"key": "trunc')
+    capsys.readouterr()
+
+    hesmatch(ref_hessian, match_hessians, journal=journal)
+    assert len(capsys.readouterr().out.strip().splitlines()) > 0
+    header, results = read_journal(journal)
+    assert len(results) == 3
+    assert [entry['indices'] for entry in results.values()] == [[0], [1], [2]]
+
+    consolidate_journals([journal], str(tmp_path / 'results.npz'))
+    with np.load(tmp_path / 'results.npz') as merged:
+        assert merged['diff'].shape == (3, 6)
+
+    # Identical match Hessians get a row each, also when resumed
+    repeated = str(tmp_path / 'repeated.jsonl')
+    hesmatch(ref_hessian, match_hessians[:2], journal=repeated)
+    hesmatch(ref_hessian, match_hessians[:2] + match_hessians[:1], journal=repeated)
+    merged = consolidate_journals([repeated])
+    assert [entry['index'] for entry in merged] == [0, 1, 2]
+    assert merged[2]['diff'] == merged[0]['diff']
+    single_run = str(tmp_path / 'single_run.jsonl')
+    capsys.readouterr()
+    hesmatch(ref_hessian, match_hessians[:2] + match_hessians[:1], journal=single_run,
+             precision='single', refine=True)
+    assert [entry['index'] for entry in consolidate_journals([single_run])] == [0, 1, 2]
+    # Within a run, repeats are reported like without a journal
+    output = capsys.readouterr().out
+    hesmatch(ref_hessian, match_hessians[:2] + match_hessians[:1], precision='single',
+             refine=True)
+    assert capsys.readouterr().out == output
+
+    with pytest.raises(ValueError):
+        hesmatch(ref_hessian, match_hessians, journal=journal, ref_unit=2)
+
+
+def test_journal_positions(tmp_path):
+    from hesmatch.journal import Journal, consolidate_journals, read_journal
+
+    results = [(np.ones(2), np.full(2, value), np.full(2, value)) for value in (1., 2.)]
+    first = Journal(str(tmp_path / 'first.jsonl'), {'ref': 'r'})
+    first.record('a', results[0], 0)
+    first.record('b', results[1], 1)
+    first.record('a', results[0], 3)
+    first.record('a', results[0], 3)
+    first.close()
+    second = Journal(str(tmp_path / 'second.jsonl'), {'ref': 'r'})
+    second.record('a', results[0], 2)
+    second.close()
+
+    assert read_journal(str(tmp_path / 'first.jsonl'))[1]['a']['indices'] == [0, 3]
+    resumed = Journal(str(tmp_path / 'first.jsonl'), {'ref': 'r'})
+    assert resumed.is_recorded('a', 3) and not resumed.is_recorded('b', 2)
+    assert np.array_equal(resumed.get_result('b')[1], [2., 2.])
+    resumed.close()
+
+    merged = consolidate_journals([str(tmp_path / 'first.jsonl'),
+                                   str(tmp_path / 'second.jsonl')])
+    assert [entry['index'] for entry in merged] == [0, 1, 2, 3]
+    assert [entry['key'] for entry in merged] == ['a', 'b', 'a', 'a']
+
+
+def test_deduplication(monkeypatch, capsys):
+    import sys
+    from hesmatch.journal import hash_hessian
+
+    rng = np.random.default_rng(13)
+    geometry = rng.normal(size=(4, 3))
+    ref_hessian = spring_hessian(geometry)
+    match_hessian = spring_hessian(geometry, 450.)
+    other_hessian = spring_hessian(geometry, 550.)
+
+    assert hash_hessian(match_hessian) == hash_hessian(np.asfortranarray(match_hessian))
+    assert hash_hessian(other_hessian) != hash_hessian(match_hessian)
+    assert hash_hessian(match_hessian, 100.) == hash_hessian(match_hessian * 100.)
+
+    hesmatch_module = sys.modules['hesmatch.hesmatch']
+    analysed = []
+    do_vibrational_analysis = hesmatch_module.do_vibrational_analysis
+
+    def counting_analysis(hessian, *args, **kwargs):
+        analysed.append(hessian)
+        return do_vibrational_analysis(hessian, *args, **kwargs)
+
+    monkeypatch.setattr(hesmatch_module, 'do_vibrational_analysis', counting_analysis)
+    capsys.readouterr()
+    hesmatch_module.hesmatch(ref_hessian, [match_hessian, other_hessian, match_hessian.copy(),
+                                           other_hessian.copy()])
+    # The reference and the two distinct match Hessians
+    assert len(analysed) == 3
+    output = capsys.readouterr().out
+    unique = [match_hessian, other_hessian]
+    hesmatch_module.hesmatch(ref_hessian, unique + unique)
+    assert capsys.readouterr().out == output
+
+
+def test_disk_cache(tmp_path, monkeypatch, capsys):
+    import sys
+    from hesmatch.cache import DiskCache
+
+    hesmatch_module = sys.modules['hesmatch.hesmatch']
+    rng = np.random.default_rng(14)
+    geometry = rng.normal(size=(4, 3))
+    ref_hessian = spring_hessian(geometry)
+    match_hessians = [spring_hessian(geometry, k) for k in (450., 550.)]
+
+    cache = DiskCache(str(tmp_path / 'cache'))
+    capsys.readouterr()
+    hesmatch_module.hesmatch(ref_hessian, match_hessians, cache=cache)
+    output = capsys.readouterr().out
+    hesmatch_module.hesmatch(ref_hessian, match_hessians, cache=cache, precision='single')
+    capsys.readouterr()
+
+    def no_matching(*args, **kwargs):
+        raise AssertionError('Cached match was matched again')
+
+    monkeypatch.setattr(hesmatch_module, 'match_to_reference', no_matching)
+    hesmatch_module.hesmatch(ref_hessian, match_hessians, cache=str(tmp_path / 'cache'))
+    assert capsys.readouterr().out == output
+
+    # Different settings miss the cache
+    with pytest.raises(AssertionError):
+        hesmatch_module.hesmatch(ref_hessian, match_hessians, cache=cache, match_unit=2)
+    hesmatch_module.hesmatch(ref_hessian, match_hessians, cache=cache, precision='single')
+    with pytest.raises(AssertionError):
+        hesmatch_module.hesmatch(ref_hessian, match_hessians, cache=cache, precision='single',
+                                 refine=True)
+
+    small = DiskCache(str(tmp_path / 'cache'), max_size=1)
+    small.put('entry', values=np.ones(10))
+    assert small.get('entry') is None
+    assert not [name for name in (tmp_path / 'cache').iterdir() if name.suffix == '.npz']
+
+
+def test_serve_socket():
+    import os
+    import socket
+    import tempfile
+    import threading
+    import time
+    from scipy.sparse import coo_matrix
+    from hesmatch.hesmatch import do_vibrational_analysis
+    from hesmatch.matching import _get_vibrations, match_to_reference
+    from hesmatch.protocol import read_frame, write_array, write_frame
+    from hesmatch.server import MatchServer, serve_socket
+
+    rng = np.random.default_rng(15)
+    geometry = rng.normal(size=(4, 3))
+    ref_hessian = spring_hessian(geometry)
+    match_hessian = spring_hessian(geometry, 450.)
+
+    server = MatchServer(ref_hessian)
+    path = os.path.join(tempfile.mkdtemp(), 'hesmatch.sock')
+    thread = threading.Thread(target=serve_socket, args=(server, path))
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path):
+        assert thread.is_alive() and time.monotonic() < deadline, 'Server did not start'
+        time.sleep(0.01)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        with client.makefile('rb') as instream, client.makefile('wb') as outstream:
+            write_array(outstream, match_hessian, id=1)
+            write_array(outstream, coo_matrix(match_hessian), id=2, format='sparse')
+            write_array(outstream, np.zeros(3), id=3)
+            replies = [read_frame(instream)[0] for _ in range(3)]
+            write_frame(outstream, {'type': 'shutdown'})
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+
+    ref_freqs, ref_modes = _get_vibrations(do_vibrational_analysis(ref_hessian, '2d', 1, None))
+    expected = match_to_reference(ref_freqs, ref_modes,
+                                  do_vibrational_analysis(match_hessian, '2d', 1, None))
+    for reply in replies[:2]:
+        assert reply['type'] == 'result'
+        assert np.allclose(reply['diff'], expected[1])
+    assert [reply['id'] for reply in replies] == [1, 2, 3]
+    assert replies[2]['type'] == 'error'
+
+
+def test_read_stream(tmp_path):
+    import io
+    from scipy.sparse import coo_matrix
+    from hesmatch.cli import iter_hessians, read_stream
+    from hesmatch.hesmatch import UNIT_FACTORS
+    from hesmatch.protocol import write_array, write_frame
+
+    rng = np.random.default_rng(16)
+    hessians = [spring_hessian(rng.normal(size=(3, 3))) for _ in range(2)]
+
+    framed = io.BytesIO()
+    write_array(framed, hessians[0])
+    write_array(framed, coo_matrix(hessians[1]))
+    write_frame(framed, {'type': 'end'})
+    with open(tmp_path / 'hessians.hesm', 'wb') as f:
+        f.write(framed.getvalue())
+
+    read = list(read_stream(io.BufferedReader(io.BytesIO(framed.getvalue())), '2d'))
+    assert np.allclose(read[0], hessians[0])
+    assert np.allclose(read[1].toarray(), hessians[1])
+    read = list(iter_hessians([str(tmp_path / 'hessians.hesm')], '2d', np.float32))
+    assert read[0].dtype == np.float32 and len(read) == 2
+
+    # Frames declaring another layout and unit are converted
+    declared = io.BytesIO()
+    write_array(declared, hessians[0][np.tril_indices(9)], format='lower', unit=3)
+    declared.seek(0)
+    read = next(read_stream(io.BufferedReader(declared), '2d', unit=1))
+    assert np.allclose(read, hessians[0] * UNIT_FACTORS[3] / UNIT_FACTORS[1])
+
+    text = io.BytesIO()
+    np.savetxt(text, hessians[0])
+    read = list(read_stream(io.BufferedReader(io.BytesIO(text.getvalue())), '2d'))
+    assert len(read) == 1 and np.allclose(read[0], hessians[0])
+
+
+@pytest.mark.parametrize('extension', ['', '.gz', '.xz', '.bz2'])
+def test_compressed_files(tmp_path, extension):
+    import io
+    from hesmatch.cli import iter_hessians
+    from hesmatch.readers import open_hessian_file, read_tokens
+
+    rng = np.random.default_rng(17)
+    hessian = spring_hessian(rng.normal(size=(3, 3)))
+    lower = hessian[np.tril_indices(9)]
+    np.savetxt(tmp_path / f'full.dat{extension}', hessian)
+    np.savetxt(tmp_path / f'lower.dat{extension}', lower)
+
+    assert np.allclose(next(iter_hessians([str(tmp_path / f'full.dat{extension}')], '2d')),
+                       hessian)
+    assert np.allclose(next(iter_hessians([str(tmp_path / f'lower.dat{extension}')], 'lower')),
+                       lower)
+    # Numbers split across chunks
+    with open_hessian_file(str(tmp_path / f'lower.dat{extension}')) as f:
+        assert np.allclose(read_tokens(f, chunk_size=7), lower)
+
+    for text in [b'1.0 2.0 three', b'1.0 2.0,3.0', b'1.0 2.0x']:
+        with pytest.raises(ValueError):
+            read_tokens(io.BytesIO(text))
+
+
+def test_qm_formats(tmp_path):
+    from ase.units import Bohr
+    from hesmatch.cli import iter_hessians
+    from hesmatch.readers import read_qm_file
+
+    rng = np.random.default_rng(18)
+    positions = rng.normal(size=(3, 3))
+    hessian = spring_hessian(positions, 0.5)
+    numbers, masses, symbols = [8, 1, 1], [15.999, 1.008, 1.008], ['O', 'H', 'H']
+    lower = hessian[np.tril_indices(9)]
+
+    def fchk_section(name, values, data_type='R'):
+        text = f'{name:<40}   {data_type}   N={len(values):>12}\n'
+        per_line = 6 if data_type == 'I' else 5
+        for start in range(0, len(values), per_line):
+            text += ''.join(f'{value:16.8E}' if data_type == 'R' else f'{value:12d}'
+                            for value in values[start:start + per_line]) + '\n'
+        return text
+
+    def column_blocks(matrix, width=5):
+        text = ''
+        for start in range(0, len(matrix), width):
+            columns = range(start, min(start + width, len(matrix)))
+            text += ''.join(f'{col:>12}' for col in columns) + '\n'
+            for row, values in enumerate(matrix):
+                text += f'{row:>6}' + ''.join(f'{values[col]:18.10E}' for col in columns) + '\n'
+        return text
+
+    (tmp_path / 'h.fchk').write_text(
+        'Water\nFreq\nNumber of atoms                            I                3\n'
+        + fchk_section('Atomic numbers', numbers, 'I')
+        + fchk_section('Current cartesian coordinates', (positions / Bohr).ravel())
+        + fchk_section('Real atomic weights', masses)
+        + fchk_section('Cartesian Force Constants', lower))
+    (tmp_path / 'h.hess').write_text(
+        '\n$orca_hessian_file\n\n$act_atom\n  0\n\n$hessian\n9\n' + column_blocks(hessian)
+        + '\n$atoms\n3\n' + ''.join(f' {s} {m:10.5f} {x:14.8f} {y:14.8f} {z:14.8f}\n'
+                                    for s, m, (x, y, z) in zip(symbols, masses, positions / Bohr))
+        + '\n$end\n')
+    (tmp_path / 'FCMFINAL').write_text(
+        '    3    9\n' + ''.join(f'{a:20.10f}{b:20.10f}{c:20.10f}\n'
+                                 for a, b, c in hessian.reshape(-1, 3)))
+    (tmp_path / 'qchem.out').write_text(
+        '             Standard Nuclear Orientation (Angstroms)\n'
+        '    I     Atom           X                Y                Z\n'
+        ' ' + '-' * 64 + '\n'
+        + ''.join(f'    {i + 1}      {s}  {x:16.10f} {y:16.10f} {z:16.10f}\n'
+                  for i, (s, (x, y, z)) in enumerate(zip(symbols, positions)))
+        + ' ' + '-' * 64 + '\n Nuclear Repulsion Energy = 9.1\n\n'
+        ' Hessian of the SCF Energy\n' + column_blocks(hessian, 6) + ' Gradient time:\n')
+
+    fchk = read_qm_file(str(tmp_path / 'h.fchk'), 'fchk')
+    assert fchk.hes_format == 'lower' and fchk.unit == 3
+    assert np.allclose(fchk.hessian, lower)
+    assert np.allclose(fchk.positions, positions)
+    assert np.allclose(fchk.masses, masses) and list(fchk.numbers) == numbers
+
+    for file, qm_format in [('h.hess', 'orca'), ('FCMFINAL', 'fcm'), ('qchem.out', 'qchem')]:
+        data = read_qm_file(str(tmp_path / file), qm_format)
+        assert np.allclose(data.hessian, hessian, atol=1e-8)
+        if qm_format != 'fcm':
+            assert np.allclose(data.positions, positions, atol=1e-6)
+            assert list(data.numbers) == numbers
+            assert np.allclose(data.masses, masses, atol=1e-2)
+
+    read = next(iter_hessians([str(tmp_path / 'h.hess')], 'orca', np.float32))
+    assert read.dtype == np.float32
+
+
+def write_mtx(path, hessian, sparse=False, double=False):
+    """
+    GROMACS .mtx file of a Hessian in full or compressed symmetric sparse storage, laid out
+    as by gmx_mtxio_write of a single or double precision build of GROMACS.
+    """
+    import struct
+    real = '>f8' if double else '>f4'
+    version = b'VERSION 2023.1'
+    data = struct.pack('>iiI', 0x34ce8fd2, len(version) + 1, len(version))
+    data += version + b'\0' * (-len(version) % 4)
+    data += struct.pack('>iiii', int(double), len(hessian), len(hessian), int(sparse))
+    if not sparse:
+        data += hessian.astype(real).tobytes()
+    else:
+        rows, cols = np.nonzero(np.triu(hessian))
+        data += struct.pack('>ii', 1, len(hessian))
+        data += np.bincount(rows, minlength=len(hessian)).astype('>i4').tobytes()
+        entries = np.empty(len(rows), dtype=[('col', '>i4'), ('value', real)])
+        entries['col'], entries['value'] = cols, hessian[rows, cols]
+        data += entries.tobytes()
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_serve_reader_formats(tmp_path, monkeypatch):
+    from ase.units import Bohr
+    from hesmatch.hesmatch import do_vibrational_analysis
+    import hesmatch.cli as cli_module
+    from hesmatch.matching import _get_vibrations
+
+    positions = np.random.default_rng(18).normal(size=(3, 3))
+    hessian = spring_hessian(positions, 0.5)
+    masses = [15.999, 1.008, 1.008]
+    blocks = ''
+    for start in range(0, 9, 5):
+        columns = range(start, min(start + 5, 9))
+        blocks += ''.join(f'{col:>12}' for col in columns) + '\n'
+        blocks += ''.join(f'{row:>6}' + ''.join(f'{values[col]:18.10E}' for col in columns)
+                          + '\n' for row, values in enumerate(hessian))
+    (tmp_path / 'h.hess').write_text(
+        '\n$orca_hessian_file\n\n$hessian\n9\n' + blocks + '\n$atoms\n3\n'
+        + ''.join(f' {s} {m:10.5f} {x:14.8f} {y:14.8f} {z:14.8f}\n'
+                  for s, m, (x, y, z) in zip('OHH', masses, positions / Bohr)) + '\n$end\n')
+
+    servers = []
+    monkeypatch.setattr(cli_module, 'serve_stdio', servers.append)
+    monkeypatch.setattr(sys, 'argv', ['hesmatch', 'serve', str(tmp_path / 'h.hess'),
+                                      '--ref_format', 'auto', '--match_format', 'mtx'])
+    cli_module.main()
+
+    server, = servers
+    assert (server.match_format, server.match_unit) == ('2d', 2)
+    assert np.allclose(server.masses, masses)
+    expected = do_vibrational_analysis(hessian, '2d', 3, np.array(masses))
+    assert np.allclose(server.ref_freqs, _get_vibrations(expected)[0])
+
+
+@pytest.mark.parametrize('sparse, double', [(False, False), (False, True), (True, False),
+                                           (True, True)])
+def test_gromacs_mtx(tmp_path, sparse, double):
+    from scipy.sparse import issparse
+    from hesmatch.gromacs import read_mtx
+    from hesmatch.hesmatch import do_vibrational_analysis
+
+    rng = np.random.default_rng(19)
+    hessian = spring_hessian(rng.normal(size=(4, 3)))
+    hessian[np.abs(hessian) < 50] = 0
+    write_mtx(tmp_path / 'nm.mtx', hessian, sparse, double)
+
+    read = read_mtx(str(tmp_path / 'nm.mtx'))
+    assert issparse(read) == sparse
+    dense = read.toarray() if sparse else read
+    assert np.allclose(dense, hessian, rtol=1e-6)
+
+    masses = np.array([12., 16., 1., 14.])
+    freqs = do_vibrational_analysis(read, '2d', 2, masses).get_frequencies()
+    expected = do_vibrational_analysis(hessian, '2d', 2, masses).get_frequencies()
+    assert np.allclose(freqs[6:], expected[6:], rtol=1e-4)
+
+
+def test_reader_registry(tmp_path):
+    import gzip
+    import subprocess
+    from hesmatch.cli import resolve_format
+    from hesmatch.readers import detect_format, get_reader, read_hessian_file
+
+    hessian = spring_hessian(np.random.default_rng(23).normal(size=(3, 3)))
+    # Detected from the magic bytes without the .mtx extension
+    write_mtx(tmp_path / 'nm.bin', hessian, True, double=True)
+    assert detect_format(str(tmp_path / 'nm.bin')) == 'mtx'
+    assert np.allclose(read_hessian_file(str(tmp_path / 'nm.bin'), 'mtx').toarray(), hessian)
+    with gzip.open(tmp_path / 'freq.hess.gz', 'wt') as f:
+        f.write('\n$orca_hessian_file\n')
+    assert detect_format(str(tmp_path / 'freq.hess.gz')) == 'orca'
+    np.savetxt(tmp_path / 'hessian.txt', hessian)
+    assert detect_format(str(tmp_path / 'hessian.txt')) is None
+    with pytest.raises(ValueError):
+        get_reader('unknown')
+    for source in ['-', '/dev/stdin']:
+        with pytest.raises(ValueError, match='stdin'):
+            resolve_format(source)
+
+    # The readers of unused formats are not imported
+    code = "import sys, hesmatch.cli; print('hesmatch.gromacs' in sys.modules)"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            check=True)
+    assert result.stdout.strip() == 'False'
@@ -32,7 +32,7 @@ setup(
     license='MIT',
     entry_points={
         "console_scripts": [
-            "hesmatch = hesmatch.cli:cli",
+            "hesmatch = hesmatch.cli:main",
         ]
     },
 